@@ -217,72 +217,144 @@ class Program:
 ##########################################################################
 ##########################################################################
 
+# Token table entry kinds.
+TOKEN_TEXT=0                    # value is the text
+TOKEN_REM=1                     # value is the text; rest of line is verbatim
+TOKEN_LINE_NUMBER=2             # value is None
+TOKEN_ESCAPE=3                  # value is list of 2-byte token texts
+
+# 256-entry token tables, indexed by byte, one per dialect/REM
+# combination. Entries are (kind,value) tuples, or None for bytes
+# that aren't tokens.
+_token_tables={}
+
+def get_dialect(options):
+    if options.basicv: return 'basicv'
+    elif options.basic2: return 'basic2'
+    else: return 'basic4'
+
+def get_token_table(dialect,rem=None):
+    '''get 256-entry token table for DIALECT - 'basic2', 'basic4' or
+'basicv'. REM is whether REM stops tokenising the rest of the line -
+by default, True unless DIALECT is 'basic2'.'''
+    if rem is None: rem=dialect!='basic2'
+    key=(dialect,rem)
+    table=_token_tables.get(key)
+    if table is not None: return table
+
+    table=[None]*256
+    for i,token in enumerate(tokens):
+        if isinstance(token,SpecialToken):
+            if dialect=='basicv': token=token.basic5
+            elif dialect=='basic2': token=token.basic2
+            else: token=token.basic4
+
+        if isinstance(token,str):
+            # Special case
+            if rem and token=='REM': kind=TOKEN_REM
+            else: kind=TOKEN_TEXT
+        elif token is None: kind=TOKEN_LINE_NUMBER
+        else: kind=TOKEN_ESCAPE
+
+        table[0x7f+i]=(kind,token)
+
+    _token_tables[key]=table
+    return table
+
+# Text for each non-token byte, with and without control codes.
+_code_chars=[chr(c) for c in range(256)]
+_no_code_chars=[' ' if c<32 or c>=128 else chr(c) for c in range(256)]
+
+##########################################################################
+##########################################################################
+
 def Detokenise(line,add_labels,program,options):
-    line_text=""
+    table=get_token_table(get_dialect(options),not options.basic2)
+    chars=_code_chars if options.codes else _no_code_chars
+    parts=[]
     i=0
+    n=len(line)
     tokenize=True
     rem=False
-    while i<len(line):
+    while i<n:
         c=line[i]
-        #print line_text
         if tokenize and c>=0x7f:
-            token=tokens[c-0x7f]
+            kind,token=table[c]
 
-            # if it's a tuple, pick BASIC 2 or BASIC V part.
-            if isinstance(token,SpecialToken):
-                if options.basicv: token=token.basic5
-                elif options.basic2: token=token.basic2
-                else: token=token.basic4
-            
-            if isinstance(token,str):
-                text=token
+            if kind==TOKEN_TEXT:
+                parts.append(token)
                 i+=1
-
-                # Special case
-                if not options.basic2 and text=="REM":
-                    tokenize=False
-                    rem=True
-            elif token is None:
+            elif kind==TOKEN_REM:
+                parts.append(token)
+                i+=1
+                tokenize=False
+                rem=True
+            elif kind==TOKEN_LINE_NUMBER:
                 # line number
-                msb=line[i+3]^((line[i+1]<<4)&0xFF)
-                lsb=line[i+2]^(((line[i+1]&0x30)<<2)&0xFF)
-                line_number=(lsb<<0)|(msb<<8)
+                line_number=DecodeLineNumber(line,i)
                 if add_labels:
                     program.add_label(line_number)
                 else:
                     if line_number in program.labels:
-                        text='@%04d'%program.labels[line_number]
-                    else: text=str(line_number)
+                        parts.append('@%04d'%program.labels[line_number])
+                    else: parts.append(str(line_number))
                                  
                 i+=4
             else:
                 # 2-byte token
-                i+=1
-                sub=line[i]
-                text=token[sub-0x8e]
-                i+=1
-
-            line_text+=text
+                parts.append(token[line[i+1]-0x8e])
+                i+=2
         else:
-            if c==ord('"'):
-                if rem:
-                    # do nothing
-                    pass
-                else: tokenize=not tokenize
-            if (c<32 or c>=128) and not options.codes: line_text+=' '
-            else: line_text+=chr(line[i])
+            if c==34 and not rem:
+                # '"'
+                tokenize=not tokenize
+            parts.append(chars[c])
             i+=1
 
-    if options.remove_leading_spaces:
-        i=0
-        while i<len(line_text) and line_text[i].isspace(): i+=1
-        line_text=line_text[i:]
+    line_text=''.join(parts)
+
+    if options.remove_leading_spaces: line_text=line_text.lstrip()
 
     return line_text
             
 ##########################################################################
 ##########################################################################
 
+def DecodeLineNumber(line,i):
+    '''decode line number token at LINE[I].'''
+    msb=line[i+3]^((line[i+1]<<4)&0xFF)
+    lsb=line[i+2]^(((line[i+1]&0x30)<<2)&0xFF)
+    return (lsb<<0)|(msb<<8)
+
+def AddLabels(line,program,options):
+    '''add labels for tokenised line LINE's line number references to
+PROGRAM, in the order Detokenise(line,True,program,options) would,
+without building any text.'''
+    if 0x8d not in line: return
+
+    table=get_token_table(get_dialect(options),not options.basic2)
+    i=0
+    n=len(line)
+    while i<n:
+        c=line[i]
+        if c==34:
+            # skip string
+            i=line.find(34,i+1)
+            if i<0: break
+            i+=1
+        elif c>=0x7f:
+            kind=table[c][0]
+            if kind==TOKEN_LINE_NUMBER:
+                program.add_label(DecodeLineNumber(line,i))
+                i+=4
+            elif kind==TOKEN_ESCAPE: i+=2
+            elif kind==TOKEN_REM: break
+            else: i+=1
+        else: i+=1
+
+##########################################################################
+##########################################################################
+
 def bad_program(): raise Exception('Bad program')
 
 def ReadLines(data,options):
@@ -308,6 +380,10 @@ def ReadLines(data,options):
 ##########################################################################
 
 def DecodeProgram(data,options):
+    # bytes(data) is a no-op for bytes, and copies anything else
+    # (bytearray, memoryview) - lines are then cheap-to-search bytes.
+    data=bytes(data)
+
     program=Program()
 
     if options.perfect:
@@ -344,8 +420,7 @@ def DecodeProgram(data,options):
         lines=ReadLines(data,options)
 
         if not options.line_numbers:
-            for num,line in lines:
-                Detokenise(line,True,program,options)
+            for num,line in lines: AddLabels(line,program,options)
 
         for num,line in lines:
             text=Detokenise(line,False,program,options)
@@ -356,6 +431,76 @@ def DecodeProgram(data,options):
 ##########################################################################
 ##########################################################################
 
+def ListProgram(program,options):
+    '''generate the text for PROGRAM, as main outputs it.'''
+    cr=chr(13) if options.cr else "\n"
+
+    for num,text in program.lines:
+        if not options.basic2 and len(text)==0:
+            # BASIC IV simply skips empty lines when listing! They're
+            # still there, though. You can see them when listing in
+            # BASIC II.
+            continue
+        
+        if num in program.labels: yield '@%04d:%s'%(program.labels[num],cr)
+
+        if options.line_numbers: yield '%5d%s%s'%(num,text,cr)
+        else: yield '%s%s'%(text,cr)
+
+##########################################################################
+##########################################################################
+
+dialects=['basic2','basic4','basicv']
+
+class Decoder:
+    '''Reusable decoder, for library use. DIALECT is one of
+dialects; other arguments are as per the command line options of the
+same name.'''
+    def __init__(self,
+                 dialect='basic4',
+                 codes=False,
+                 perfect=False,
+                 line_numbers=True,
+                 remove_leading_spaces=False,
+                 cr=False):
+        if dialect not in dialects:
+            raise ValueError('unknown BASIC dialect: %s'%dialect)
+        if perfect and not line_numbers:
+            raise ValueError('perfect and line_numbers=False are mutually exclusive')
+
+        self.dialect=dialect
+        self.basic2=dialect=='basic2'
+        self.basicv=dialect=='basicv'
+        self.codes=codes
+        self.perfect=perfect
+        self.line_numbers=line_numbers
+        self.remove_leading_spaces=remove_leading_spaces
+        self.cr=cr
+
+    def decode_program(self,data):
+        '''decode tokenised BASIC DATA, giving a Program.'''
+        return DecodeProgram(data,self)
+
+    def decode(self,data):
+        '''decode tokenised BASIC DATA, giving list of (line number,
+text).'''
+        return self.decode_program(data).lines
+
+    def get_text(self,data):
+        '''decode tokenised BASIC DATA, giving text as main would
+output it.'''
+        return ''.join(ListProgram(self.decode_program(data),self))
+
+    def decode_many(self,paths):
+        '''decode each tokenised BASIC file in PATHS, generating
+(path,decode result) for each in turn.'''
+        for path in paths:
+            with open(path,'rb') as f: data=f.read()
+            yield path,self.decode(data)
+
+##########################################################################
+##########################################################################
+
 def main(argv):
     parser=optparse.OptionParser(usage="%prog [options] INPUT (OUTPUT)\n\n If no INPUT specified, or INPUT is -, read from stdin. If no OUTPUT specified, print output to stdout.")
     parser.add_option('-2',
@@ -403,25 +548,9 @@ def main(argv):
         if len(args)>=2: output=open(args[1],'wt')
         else: output=sys.stdout
         
-    cr=chr(13) if options.cr else "\n"
-
-    def write(str):
-        if options.codes: output.write(str.encode('latin_1'))
-        else: output.write(str)
-    
-    for num,text in program.lines:
-        if not options.basic2 and len(text)==0:
-            # BASIC IV simply skips empty lines when listing! They're
-            # still there, though. You can see them when listing in
-            # BASIC II.
-            continue
-        
-        if num in program.labels:
-            write('@%04d:%s'%(program.labels[num],cr))
-
-        if options.line_numbers: write('%5d'%num)
-
-        write('%s%s'%(text,cr))
+    for text in ListProgram(program,options):
+        if options.codes: output.write(text.encode('latin_1'))
+        else: output.write(text)
 
     if output is not sys.stdout: output.close()
 
@@ -0,0 +1,369 @@
+#!/usr/bin/python3
+import sys,argparse,re
+
+import BBCBasicToText
+
+##########################################################################
+##########################################################################
+
+def fatal(msg):
+    sys.stderr.write('FATAL: %s\n'%msg)
+    sys.exit(1)
+
+##########################################################################
+##########################################################################
+
+# Tokenise LIST-style text, as output by BBCBasicToText, into
+# tokenised BBC BASIC. The keywords come from BBCBasicToText's token
+# tables, and the rules follow the BASIC II tokeniser's keyword flags,
+# extended for the BASIC V keywords.
+
+# Keyword flags.
+COND=0x01          # not a keyword if followed by a name character
+MIDDLE=0x02        # continue mid-statement afterwards
+START=0x04         # a new statement follows
+FNPROC=0x08        # the following name isn't tokenised
+LINE_NUMBER=0x10   # following numbers are line numbers
+VERBATIM=0x20      # rest of line isn't tokenised
+
+keyword_flags={
+    'AUTO':LINE_NUMBER,
+    'BGET':COND,
+    'BPUT':COND|MIDDLE,
+    'CALL':MIDDLE,
+    'CHAIN':MIDDLE,
+    'CLEAR':COND,
+    'CLG':COND,
+    'CLOSE':COND|MIDDLE,
+    'CLS':COND,
+    'COLOUR':MIDDLE,
+    'COUNT':COND,
+    'DATA':VERBATIM,
+    'DELETE':LINE_NUMBER,
+    'DIM':MIDDLE,
+    'DRAW':MIDDLE,
+    'ELSE':START|LINE_NUMBER,
+    'END':COND,
+    'ENDPROC':COND,
+    'ENVELOPE':MIDDLE,
+    'EOF':COND,
+    'ERL':COND,
+    'ERR':COND,
+    'ERROR':START,
+    'EXT':COND,
+    'FALSE':COND,
+    'FN':FNPROC,
+    'FOR':MIDDLE,
+    'GCOL':MIDDLE,
+    'GOSUB':MIDDLE|LINE_NUMBER,
+    'GOTO':MIDDLE|LINE_NUMBER,
+    'HIMEM':COND|MIDDLE,
+    'IF':MIDDLE,
+    'INPUT':MIDDLE,
+    'LET':START,
+    'LIST':LINE_NUMBER,
+    'LOAD':MIDDLE,
+    'LOCAL':MIDDLE,
+    'LOMEM':COND|MIDDLE,
+    'MODE':MIDDLE,
+    'MOVE':MIDDLE,
+    'NEW':COND,
+    'NEXT':MIDDLE,
+    'OLD':COND,
+    'ON':MIDDLE,
+    'OSCLI':MIDDLE,
+    'PAGE':COND|MIDDLE,
+    'PI':COND,
+    'PLOT':MIDDLE,
+    'POS':COND,
+    'PRINT':MIDDLE,
+    'PROC':FNPROC|MIDDLE,
+    'PTR':COND|MIDDLE,
+    'READ':MIDDLE,
+    'REM':VERBATIM,
+    'RENUMBER':LINE_NUMBER,
+    'REPORT':COND,
+    'RESTORE':MIDDLE|LINE_NUMBER,
+    'RETURN':COND,
+    'RND':COND,
+    'RUN':COND,
+    'SAVE':MIDDLE,
+    'SOUND':MIDDLE,
+    'STOP':COND,
+    'THEN':START|LINE_NUMBER,
+    'TIME':COND|MIDDLE,
+    'TRACE':MIDDLE|LINE_NUMBER,
+    'TRUE':COND,
+    'UNTIL':MIDDLE,
+    'VDU':MIDDLE,
+    'VPOS':COND,
+    'WIDTH':MIDDLE,
+
+    # BASIC V
+    'APPEND':MIDDLE,
+    'BEATS':MIDDLE,
+    'CASE':MIDDLE,
+    'CIRCLE':MIDDLE,
+    'CRUNCH':MIDDLE,
+    'EDIT':MIDDLE,
+    'ELLIPSE':MIDDLE,
+    'FILL':MIDDLE,
+    'INSTALL':MIDDLE,
+    'LIBRARY':MIDDLE,
+    'MOUSE':MIDDLE,
+    'OF':MIDDLE,
+    'ORIGIN':MIDDLE,
+    'OTHERWISE':START,
+    'OVERLAY':MIDDLE,
+    'PSET':MIDDLE,
+    'QUIT':MIDDLE,
+    'RECT':MIDDLE,
+    'STEREO':MIDDLE,
+    'SWAP':MIDDLE,
+    'SYS':MIDDLE,
+    'TEMPO':MIDDLE,
+    'TEXTLOAD':MIDDLE,
+    'TEXTSAVE':MIDDLE,
+    'TINT':MIDDLE,
+    'VOICE':MIDDLE,
+    'VOICES':MIDDLE,
+    'WAIT':MIDDLE,
+    'WHEN':MIDDLE,
+    'WHILE':MIDDLE,
+}
+
+name_chars=frozenset('ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789_`')
+digits=frozenset('0123456789')
+hex_digits=frozenset('0123456789ABCDEF')
+
+##########################################################################
+##########################################################################
+
+# Trie node entry for a complete keyword.
+class Keyword:
+    def __init__(self,text):
+        self.text=text
+        self.flags=keyword_flags.get(text,0)
+        # tokens for this keyword, in token order. Where there are
+        # two, the second is used at the start of a statement (e.g.,
+        # PTR=, TIME=; BASIC V's multi-line ELSE).
+        self.tokens=[]
+
+def get_keyword_trie(dialect):
+    '''get keyword trie for DIALECT, built from BBCBasicToText's token
+table. Each node is a dict mapping a character to the next node;
+the None key, if present, is the Keyword ending there.'''
+    root={}
+    for c,entry in enumerate(BBCBasicToText.get_token_table(dialect)):
+        if entry is None: continue
+
+        kind,value=entry
+        if kind==BBCBasicToText.TOKEN_TEXT or kind==BBCBasicToText.TOKEN_REM:
+            texts=[(value,bytes([c]))]
+        elif kind==BBCBasicToText.TOKEN_ESCAPE:
+            texts=[(text,bytes([c,0x8e+i])) for i,text in enumerate(value)]
+        else: continue
+
+        for text,token in texts:
+            # skip non-keywords, such as BASIC II's 0x7f
+            if len(text)==0 or not text[0].isalpha(): continue
+
+            node=root
+            for ch in text: node=node.setdefault(ch,{})
+            if None not in node: node[None]=Keyword(text)
+            node[None].tokens.append(token)
+
+    return root
+
+##########################################################################
+##########################################################################
+
+def EncodeLineNumber(line_number):
+    '''encode LINE_NUMBER as a 4-byte 0x8d line number token.'''
+    lsb=line_number&0xff
+    msb=line_number>>8
+    return bytes([0x8d,
+                  (((lsb&0xc0)>>2)|((msb&0xc0)>>4))^0x54,
+                  (lsb&0x3f)|0x40,
+                  (msb&0x3f)|0x40])
+
+##########################################################################
+##########################################################################
+
+max_line_number=32767
+
+class Tokeniser:
+    '''Reusable tokeniser. DIALECT is one of BBCBasicToText.dialects.'''
+    def __init__(self,dialect='basic4'):
+        if dialect not in BBCBasicToText.dialects:
+            raise ValueError('unknown BASIC dialect: %s'%dialect)
+
+        self.dialect=dialect
+        self._trie=get_keyword_trie(dialect)
+
+    def _match_keyword(self,text,i):
+        # longest match
+        node=self._trie
+        keyword=None
+        end=i
+        while i<len(text):
+            node=node.get(text[i])
+            if node is None: break
+            i+=1
+            if None in node:
+                keyword=node[None]
+                end=i
+
+        return keyword,end
+
+    def tokenise_line(self,text):
+        '''tokenise TEXT, the text of one line (no line number), giving
+bytes.'''
+        output=bytearray()
+        i=0
+        n=len(text)
+        start=True              # at start of statement?
+        line_number=False       # expecting line numbers?
+        while i<n:
+            c=text[i]
+
+            if line_number:
+                if c in digits:
+                    j=i
+                    while j<n and text[j] in digits: j+=1
+                    value=int(text[i:j])
+                    if value<=max_line_number:
+                        output+=EncodeLineNumber(value)
+                    else: output+=text[i:j].encode('latin_1')
+                    i=j
+                    start=False
+                    continue
+                elif c!=' ' and c!=',': line_number=False
+
+            if c=='"':
+                # string
+                j=text.find('"',i+1)
+                if j<0: j=n
+                else: j+=1
+                output+=text[i:j].encode('latin_1')
+                i=j
+                start=False
+            elif c==':':
+                output.append(58)
+                i+=1
+                start=True
+            elif c=='*' and start:
+                # OSCLI command - rest of line is verbatim
+                output+=text[i:].encode('latin_1')
+                break
+            elif c=='&':
+                # hex number
+                j=i+1
+                while j<n and text[j] in hex_digits: j+=1
+                output+=text[i:j].encode('latin_1')
+                i=j
+                start=False
+            elif c in digits or c=='.':
+                j=i+1
+                while j<n and (text[j] in digits or text[j]=='.'): j+=1
+                output+=text[i:j].encode('latin_1')
+                i=j
+                start=False
+            elif c in name_chars:
+                keyword,end=None,i
+                if 'A'<=c<='Z': keyword,end=self._match_keyword(text,i)
+
+                if (keyword is not None and
+                    not (keyword.flags&COND and end<n and text[end] in name_chars)):
+                    if start and len(keyword.tokens)>1:
+                        output+=keyword.tokens[1]
+                    else: output+=keyword.tokens[0]
+                    i=end
+
+                    if keyword.flags&VERBATIM:
+                        output+=text[i:].encode('latin_1')
+                        break
+
+                    if keyword.flags&FNPROC:
+                        while i<n and text[i] in name_chars:
+                            output.append(ord(text[i]))
+                            i+=1
+
+                    if keyword.flags&START: start=True
+                    elif keyword.flags&MIDDLE: start=False
+
+                    if keyword.flags&LINE_NUMBER: line_number=True
+                else:
+                    # variable name
+                    j=i+1
+                    while j<n and text[j] in name_chars: j+=1
+                    output+=text[i:j].encode('latin_1')
+                    i=j
+                    start=False
+            else:
+                output+=c.encode('latin_1')
+                i+=1
+                if c!=' ': start=False
+
+        return bytes(output)
+
+    def tokenise(self,text):
+        '''tokenise TEXT, LIST-style text with a line number at the
+start of each line, giving tokenised program bytes. Blank lines are
+ignored. Raises ValueError if TEXT is invalid.'''
+        output=bytearray()
+        for index,line in enumerate(re.split('\r\n|\r|\n',text)):
+            if len(line.strip())==0: continue
+
+            m=re.match(r' *([0-9]+)',line)
+            if m is None:
+                raise ValueError('line %d: missing line number'%(index+1))
+
+            num=int(m.group(1))
+            if num>max_line_number:
+                raise ValueError('line %d: bad line number: %d'%(index+1,num))
+
+            data=self.tokenise_line(line[m.end():])
+            if 4+len(data)>255:
+                raise ValueError('line %d: line too long'%(index+1))
+
+            output+=bytes([13,num>>8,num&0xff,4+len(data)])
+            output+=data
+
+        output+=b'\x0d\xff'
+        return bytes(output)
+
+##########################################################################
+##########################################################################
+
+def main2(options):
+    if options.input_path=='-': data=sys.stdin.buffer.read()
+    else:
+        with open(options.input_path,'rb') as f: data=f.read()
+
+    tokeniser=Tokeniser(options.dialect)
+    try: program=tokeniser.tokenise(data.decode('latin_1'))
+    except ValueError as e: fatal('%s: %s'%(options.input_path,e))
+
+    if options.output_path is None or options.output_path=='-':
+        sys.stdout.buffer.write(program)
+    else:
+        with open(options.output_path,'wb') as f: f.write(program)
+
+##########################################################################
+##########################################################################
+
+def main(argv):
+    parser=argparse.ArgumentParser(description='''tokenise LIST-style BBC BASIC text, e.g., as produced by BBCBasicToText''')
+
+    parser.add_argument('-2','--basic2',action='store_const',const='basic2',dest='dialect',default='basic4',help='''tokenise for 6502 BASIC II rather than 6502 BASIC IV''')
+    parser.add_argument('-5','--basicv',action='store_const',const='basicv',dest='dialect',help='''tokenise for BASIC V rather than 6502 BASIC IV''')
+    parser.add_argument('input_path',metavar='INPUT',help='''read text from %(metavar)s, or stdin if -''')
+    parser.add_argument('output_path',metavar='OUTPUT',nargs='?',help='''write tokenised BASIC to %(metavar)s. Default: stdout''')
+
+    main2(parser.parse_args(argv))
+
+##########################################################################
+##########################################################################
+
+if __name__=='__main__': main(sys.argv[1:])
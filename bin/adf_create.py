@@ -1,5 +1,7 @@
 #!/usr/bin/python3
-import os,os.path,sys,collections,argparse,glob,numbers,functools,fnmatch
+import os,os.path,sys,collections,argparse,glob,numbers,fnmatch,re,adfs,bbc_inf,image_cache,inf_scan
+
+emacs=os.getenv("EMACS") is not None
 
 # see http://mdfs.net/Docs/Comp/Disk/Format/ADFS
 
@@ -36,9 +38,13 @@ class BeebFile:
                  name,
                  load_addr,
                  exec_addr,
-                 locked):
+                 locked,
+                 size=None):
+        # if DATA is None, the data is read from PATH when needed, and
+        # SIZE is its size.
         self._path=path
         self._data=data
+        self._size=len(data) if data is not None else size
         self._dir=dir
         self._name=name
         self._load_addr=load_addr
@@ -66,6 +72,9 @@ class BeebFile:
     @property
     def locked(self): return self._locked
 
+    @property
+    def size(self): return self._size
+
 ##########################################################################
 ##########################################################################
 
@@ -97,16 +106,16 @@ class BeebDir:
         assert isinstance(f,BeebFile)
         self._add(f)
 
-    def get_or_create_dir(self,name):
+    def get_or_create_dir(self,name,title=None):
         item=self._find(name)
         if item is None:
-            d=BeebDir(self,None)
+            d=BeebDir(self,name,title)
             self._add(d)
             return d
         else:
             if isinstance(item,BeebFile):
-                fatal('file already exists: %s.%s'%(self.get_name(),
-                                                    item.name))
+                raise ValueError('file already exists: %s.%s'%(self.get_name(),
+                                                               item.name))
 
             return item
 
@@ -117,12 +126,12 @@ class BeebDir:
 
     def _add(self,item):
         if len(self._items)==47:
-            fatal('too many entries in dir: %s'%self.get_name())
+            raise ValueError('too many entries in dir: %s'%self.get_name())
 
         nameu=item.name.upper()
         if nameu in self._name_map:
-            fatal('name already exists: %s.%s'%(self.get_name(),
-                                                item.name))
+            raise ValueError('name already exists: %s.%s'%(self.get_name(),
+                                                           item.name))
 
         idx=len(self._items)
         self._name_map[nameu]=idx
@@ -154,17 +163,6 @@ def create_beeb_file(fname,inf_data,options):
         sys.stderr.write('NOTE: Ignoring %s: BBC name too long: %s\n'%(fname,inf_data[0]))
         return None
 
-    if options.all_non_writeable: locked=True
-    else:
-        locked=False
-        if len(inf_data)>=4:
-            if inf_data[3].lower()=='l': locked=True
-            else:
-                try:
-                    attr=int(inf_data[3],16)
-                    locked=(attr&8)!=0
-                except ValueError: pass
-
     with open(fname,'rb') as f: data=f.read()
 
     return BeebFile(fname,
@@ -173,7 +171,20 @@ def create_beeb_file(fname,inf_data,options):
                     inf_data[0][2:],
                     get_file_address(inf_data[1]),
                     get_file_address(inf_data[2]),
-                    locked)
+                    is_locked(inf_data,options))
+
+def is_locked(inf_data,options):
+    if options.all_non_writeable: return True
+
+    if len(inf_data)>=4:
+        if inf_data[3].lower()=='l': return True
+        else:
+            try:
+                attr=int(inf_data[3],16)
+                return (attr&8)!=0
+            except ValueError: pass
+
+    return False
 
 ##########################################################################
 ##########################################################################
@@ -206,16 +217,10 @@ def find_beeb_files(options):
     fnames=get_unique_paths(fnames)
 
     beeb_files=[]
-    for fname in fnames:
-        inf_path=fname+'.inf'
-        if not os.path.isfile(inf_path): inf_lines=[]
-        else: 
-            with open(fname+'.inf','rt') as f: inf_lines=f.readlines()
-            
-        if len(inf_lines)==0:
+    for fname,inf_path,inf_data in inf_scan.scan_files_for_options(fnames,options):
+        if inf_data is None:
             # Unclever bodge.
             inf_data=[os.path.basename(fname),'ffffffff','ffffffff']
-        else: inf_data=inf_lines[0].split()
 
         beeb_file=create_beeb_file(fname,inf_data,options)
         if beeb_file is not None: beeb_files.append(beeb_file)
@@ -225,146 +230,270 @@ def find_beeb_files(options):
 ##########################################################################
 ##########################################################################
 
-ADFSImage=collections.namedtuple('ADFSImage','sectors num_files num_dirs num_bytes num_used_sectors')
+# KEY=VALUE extra, as written by adf_extract.write_inf: VALUE is
+# either "quoted" (with no " inside) or has no spaces. Anything else
+# is a whitespace-separated field, taken as is - ADFS names can
+# contain ' and ".
+inf_part_re=re.compile(r'''([A-Za-z_][A-Za-z0-9_]*)=(?:"([^"]*)"|(\S*))|(\S+)''')
+
+def read_inf(path):
+    """read .inf file PATH, if it exists. Returns tuple of (list of
+    fields,dict of KEY=VALUE extras), or None."""
+    if not os.path.isfile(path): return None
+
+    with open(path,'rt') as f: line=f.readline()
+
+    # the name is always the first field.
+    parts=line.split(None,1)
+    if len(parts)==0: return None
+
+    fields=parts[:1]
+    kvs={}
+    for m in inf_part_re.finditer(''.join(parts[1:])):
+        if m.group(4) is not None: fields.append(m.group(4))
+        elif m.group(2) is not None: kvs[m.group(1)]=m.group(2)
+        else: kvs[m.group(1)]=m.group(3)
+
+    return fields,kvs
+
+def load_tree(root_path,title,options):
+    """load folder tree ROOT_PATH, laid out as adf_extract writes it,
+    as ADFS tree: each PC folder is an ADFS directory. Names, addresses
+    and attributes come from .inf files, where present. File data isn't
+    loaded."""
+    if len(title)>max_title_len:
+        raise ValueError('title is too long - max %d chars'%max_title_len)
+
+    def add_dir(dir,path):
+        with os.scandir(path) as it: pc_entries=sorted(it,key=lambda e:e.name)
+
+        for pc_entry in pc_entries:
+            if (pc_entry.name.startswith('.') or
+                pc_entry.name.lower().endswith('.inf')):
+                continue
+
+            fields,kvs=read_inf(pc_entry.path+'.inf') or ([pc_entry.name],{})
+
+            name=fields[0]
+            if len(name)>10 or '.' in name:
+                sys.stderr.write('NOTE: Ignoring %s: not a valid ADFS name: %s\n'%(pc_entry.path,name))
+                continue
+
+            if pc_entry.is_dir():
+                title=kvs.get('DIRTITLE')
+                if title is not None: title=title[:max_title_len]
+
+                add_dir(dir.get_or_create_dir(name,title),pc_entry.path)
+            elif pc_entry.is_file():
+                if len(fields)<3: fields=[name,'ffffffff','ffffffff']
+
+                # adf_extract writes name, load, exec, size, attr. A
+                # file is added as non-writeable if locked or not
+                # writeable.
+                if len(fields)>=5 and not options.all_non_writeable:
+                    try: locked=(int(fields[4],16)&0x0a)!=0x02
+                    except ValueError: locked=False
+                else: locked=is_locked(fields,options)
+
+                dir.add_file(BeebFile(pc_entry.path,
+                                      None,
+                                      None,
+                                      name,
+                                      get_file_address(fields[1]),
+                                      get_file_address(fields[2]),
+                                      locked,
+                                      pc_entry.stat().st_size))
+
+    root_dir=BeebDir(None,'$',title)
+    add_dir(root_dir,root_path)
+    return root_dir
+
+##########################################################################
+##########################################################################
+
+ADFSImage=collections.namedtuple('ADFSImage','num_sectors num_files num_dirs num_bytes num_used_sectors')
 
 # ITEM is BeebDir or BeebFile; DATA is the 0x1a bytes of ADFS
-# catalogue data. The catalogue entries are Inreated the order
+# catalogue data. The catalogue entries are created in the order
 # specified, then sorted by name just before the directory data is put
 # together.
 CatalogueEntry=collections.namedtuple('CatalogueEntry','item data')
 
+# SECTOR is the first sector; CONTENTS is the data (bytes-like), or
+# the BeebFile whose data goes there.
+Region=collections.namedtuple('Region','sector contents')
+
+# ADFS hard disk sector addresses are 21 bits - the top 3 bits of the
+# 24-bit address are the drive number.
+max_hard_disk_num_sectors=1<<21
+
 # this should really just be a function, but Python's scoping is too
 # annoying...
+#
+# The layout is done up front, and only directories and the free space
+# map are held in memory. File data is copied in (or read from disk,
+# for BeebFiles with no data) as the image is produced, by get_data or
+# write.
 class ADFSImageBuilder:
     def __init__(self,
                  root_dir,
                  disk_id,
                  boot_option,
                  max_num_sectors):
+        """MAX_NUM_SECTORS is the disk size, or None to make it just
+        large enough."""
         self._root_dir=root_dir
         self._max_num_sectors=max_num_sectors
-        
+
         self._num_files=0
         self._num_dirs=0
         self._num_bytes=0
 
-        self._sectors=[]
+        # Sectors are allocated from the start, so regions are in
+        # sector order.
+        self._regions=[]
+        self._num_sectors=0
 
         # book 2 sectors for the free space map - filled in later.
-        for i in range(2): self._add_sector(bytearray(256))
-
-        # build the sectors.
-        self._append_dir(root_dir,len(self._sectors))
-
-        self._init_free_space_map(disk_id,
-                                  boot_option)
+        self._alloc_region(2)
 
-        num_used_sectors=len(self._sectors)
+        # lay out the sectors.
+        self._append_dir(root_dir,self._num_sectors)
 
-        # expand disk image to the full size.
-        while len(self._sectors)<self._max_num_sectors:
-            self._add_sector(bytearray(256))
+        if self._max_num_sectors is None:
+            self._max_num_sectors=self._num_sectors
 
-        self._check()
+        self._regions[0]=Region(0,self._get_free_space_map(disk_id,
+                                                           boot_option))
 
-        # add free space map checksums
-        for i in range(2):
-            sum=255
-            for j in range(254,-1,-1):
-                if sum>255: sum=(sum+1)&0xff
-                sum+=self._sectors[i][j]
-            self._sectors[i][0xff]=sum&0xff
-
-        self._check()
-
-        self._image=ADFSImage(self._sectors,
+        self._image=ADFSImage(self._max_num_sectors,
                               self._num_files,
                               self._num_dirs,
                               self._num_bytes,
-                              num_used_sectors)
+                              self._num_sectors)
 
     @property
     def image(self): return self._image
 
+    def get_data(self):
+        """get the disk image, in logical sector order, as a
+        bytearray."""
+        data=bytearray(self._max_num_sectors*256)
+
+        # the image is zero-filled, so the last sector of each region
+        # is padded already.
+        for sector,contents in self._get_regions():
+            offset=sector*256
+            data[offset:offset+len(contents)]=contents
+
+        return data
+
+    def write(self,f):
+        """write the disk image, in logical sector order, to file F."""
+        num_bytes=0
+        for sector,contents in self._get_regions():
+            assert num_bytes==sector*256
+            f.write(contents)
+            num_bytes+=len(contents)
+            if num_bytes%256!=0:
+                f.write(bytes(256-num_bytes%256))
+                num_bytes+=256-num_bytes%256
+
+        # free space is zeros.
+        zeros=bytes(1024*1024)
+        while num_bytes<self._max_num_sectors*256:
+            n=min(len(zeros),self._max_num_sectors*256-num_bytes)
+            f.write(zeros[:n])
+            num_bytes+=n
+
+    def _get_regions(self):
+        for region in self._regions:
+            if not isinstance(region.contents,BeebFile): yield region
+            else:
+                data=region.contents.data
+                if data is None:
+                    with open(region.contents.path,'rb') as f: data=f.read()
+
+                    if len(data)!=region.contents.size:
+                        raise ValueError('file changed size: %s'%region.contents.path)
+
+                yield Region(region.sector,data)
+
     def _set_le(self,arr,idx,nbytes,value):
         assert isinstance(value,numbers.Number),value
-        for i in range(nbytes):
-            arr[idx+i]=value&0xff
-            value>>=8
-
-        assert value==0
+        assert value>=0 and value<(1<<nbytes*8),value
+        arr[idx:idx+nbytes]=value.to_bytes(nbytes,'little')
 
     def _set_str(self,arr,idx,value):
         assert isinstance(value,str)
-        for i in range(len(value)): arr[idx+i]=ord(value[i])
-
-    def _check(self):
-        assert len(self._sectors)<=self._max_num_sectors
-        # for i,s in enumerate(self._sectors):
-        #     assert isinstance(s,list)
-        #     assert len(s)==256
-        #     for j in range(256):
-        #         assert isinstance(s[j],int)
-        #         assert s[j]>=0 and s[j]<=256
-
-    def _init_free_space_map(self,
-                             disk_id,
-                             boot_option):
-        s=self._sectors[0]
-
-        if len(self._sectors)<self._max_num_sectors:
+        arr[idx:idx+len(value)]=value.encode('latin_1')
+
+    def _get_free_space_map(self,
+                            disk_id,
+                            boot_option):
+        data=bytearray(512)
+
+        if self._num_sectors<self._max_num_sectors:
             # There's just one big block of free space at the end...
-            self._set_le(self._sectors[0],0,3,
-                         len(self._sectors))
-        
-            self._set_le(self._sectors[1],0,3,
-                         self._max_num_sectors-len(self._sectors))
+            self._set_le(data,0x000,3,
+                         self._num_sectors)
+
+            self._set_le(data,0x100,3,
+                         self._max_num_sectors-self._num_sectors)
 
-            self._sectors[1][0xfe]=3
+            data[0x1fe]=3
 
         # Set disk size.
-        self._set_le(self._sectors[0],0xfc,3,self._max_num_sectors)
+        self._set_le(data,0x0fc,3,self._max_num_sectors)
 
         # Set disk identifier.
-        self._set_le(self._sectors[1],0xfb,2,disk_id)
+        self._set_le(data,0x1fb,2,disk_id)
 
         # Set boot option.
-        self._sectors[1][0xfd]=boot_option
+        data[0x1fd]=boot_option
 
-        self._check()
+        # add free space map checksums
+        view=memoryview(data)
+        for i in range(2):
+            data[i*256+0xff]=adfs.get_checksum(view[i*256:i*256+256])
+
+        return data
 
-    def _add_sector(self,data):
-        if len(self._sectors)==self._max_num_sectors:
-            fatal('disk image is too large')
+    def _alloc_region(self,num_sectors,contents=None):
+        """allocate NUM_SECTORS sectors for CONTENTS, returning index
+        of the region."""
+        if self._max_num_sectors is None: max_num_sectors=max_hard_disk_num_sectors
+        else: max_num_sectors=self._max_num_sectors
 
-        self._sectors.append(data)
+        if self._num_sectors+num_sectors>max_num_sectors:
+            raise ValueError('disk image is too large')
+
+        self._regions.append(Region(self._num_sectors,contents))
+        self._num_sectors+=num_sectors
+        return len(self._regions)-1
 
     def _append_file(self,f):
         self._num_files+=1
-        self._num_bytes+=len(f.data)
-        
-        file_sector_idx=len(self._sectors)
-        
-        data=bytearray(f.data)
-        while len(data)%256!=0: data.append(0)
-        for i in range(0,len(data),256): self._add_sector(data[i:i+256])
-        
-        return file_sector_idx
+        self._num_bytes+=f.size
+
+        region_idx=self._alloc_region((f.size+255)//256,f)
+
+        return self._regions[region_idx].sector
 
     def _append_dir(self,dir,parent_dir_sector_idx):
         self._num_dirs+=1
-        
-        # book 5 sectors for this directory.
-        dir_sector_idx=len(self._sectors)
-        for i in range(5): self._add_sector(None)
+
+        # book 5 sectors for this directory - filled in once the
+        # contents are laid out.
+        region_idx=self._alloc_region(5)
+        dir_sector_idx=self._regions[region_idx].sector
 
         entries=[]
         for item in dir.get_items():
             entry=CatalogueEntry(item,bytearray(0x1a))
             entries.append(entry)
 
-            for i in range(len(entry.item.name)):
-                entry.data[i]=ord(entry.item.name[i])
+            self._set_str(entry.data,0,entry.item.name)
 
             entry.data[0]|=0x80   # readable
 
@@ -372,11 +501,11 @@ class ADFSImageBuilder:
                 if not item.locked: entry.data[1]|=0x80 # writeable
                 self._set_le(entry.data,0x0a,4,item.load_addr)
                 self._set_le(entry.data,0x0e,4,item.exec_addr)
-                self._set_le(entry.data,0x12,4,len(item.data))
+                self._set_le(entry.data,0x12,4,item.size)
                 self._set_le(entry.data,0x16,3,self._append_file(entry.item))
             elif isinstance(item,BeebDir):
                 entry.data[3]|=0x80 # is directory
-                
+
                 # presumably load, exec and length are irrelevant?
 
                 self._set_le(entry.data,0x16,3,
@@ -385,40 +514,27 @@ class ADFSImageBuilder:
 
             # presumably sequence number can be left at zero?
 
-        def cmp_items(a,b):
-            aname=a.item.name.upper()
-            bname=b.item.name.upper()
-            if aname<bname: return -1
-            elif aname>bname: return 1
-            else: return 0
-
-        entries.sort(key=functools.cmp_to_key(cmp_items))
+        entries.sort(key=lambda entry:entry.item.name.upper())
 
         # fill out catalogue as flat array of 5 sectors of data.
-        data=bytearray(b'\x00Hugo')
-        
-        for entry in entries: data+=entry.data
-
-        # pad to 5 sectors in length.
-        while len(data)<5*256: data.append(0)
+        data=bytearray(5*256)
+        data[0:5]=b'\x00Hugo'
+        data[5:5+len(entries)*0x1a]=b''.join(entry.data for entry in entries)
 
         # fill in small directory footer.
         self._set_str(data,0x4cc,dir.name)
         if dir.title is not None:
             self._set_str(data,0x4d9,dir.title)
-            
+
         self._set_le(data,0x4d6,3,parent_dir_sector_idx)
 
         # copy header to footer.
-        for i in range(5): data[0x4fa+i]=data[0x000+i]
+        data[0x4fa:0x4ff]=data[0x000:0x005]
 
-        # split directory into sectors
-        for i in range(5):
-            assert self._sectors[dir_sector_idx+i] is None
-            self._sectors[dir_sector_idx+i]=data[i*256:i*256+256]
+        self._regions[region_idx]=Region(dir_sector_idx,data)
 
         return dir_sector_idx
-    
+
 ##########################################################################
 ##########################################################################
 
@@ -429,6 +545,9 @@ g_adfs_formats={
     'L':ADFSFormat(2,80,16),
 }
 
+# Hard disk images are in logical sector order, and any size.
+hard_disk_type='H'
+
 def get_formats_text():
     formats=[]
 
@@ -438,19 +557,155 @@ def get_formats_text():
                                         v.num_tracks,
                                         v.num_sectors))
 
+    formats.append('%s (hard disk - see --size)'%hard_disk_type)
+
     return ', '.join(formats)
 
 ##########################################################################
 ##########################################################################
 
+max_title_len=19
+
+def get_root_dir(files,title):
+    """form ADFS tree from FILES, an iterable of (name,load,exec,attr,
+    data) records. Files in $ go in the root, and files in other DFS
+    directories go in ADFS directories of the same name. Raises
+    ValueError if the input is invalid."""
+    if len(title)>max_title_len:
+        raise ValueError('title is too long - max %d chars'%max_title_len)
+
+    root_dir=BeebDir(None,'$',title)
+
+    for name,load,exec_,attr,data in files:
+        if len(name)<3 or name[1]!='.':
+            raise ValueError('BBC name not a DFS-style name: %s'%name)
+
+        if len(name)>12: raise ValueError('BBC name too long: %s'%name)
+
+        f=BeebFile(None,
+                   data,
+                   name[0],
+                   name[2:],
+                   load,
+                   exec_,
+                   (attr&bbc_inf.LOCKED_ATTR)!=0)
+
+        if f.dir=='$': root_dir.add_file(f)
+        else:
+            d=root_dir.get_or_create_dir(f.dir)
+            d.add_file(f)
+
+    return root_dir
+
+def create_adfs_image_builder(root_dir,boot_option,disk_id,type,num_sectors=None):
+    """lay out ADFS disk image of format TYPE for tree ROOT_DIR. For a
+    hard disk image, NUM_SECTORS is the size, or None to make it just
+    large enough. Returns the ADFSImageBuilder. Raises ValueError if
+    the settings are invalid or the tree doesn't fit."""
+    type=type.upper()
+    if type==hard_disk_type:
+        if num_sectors is not None:
+            if num_sectors<7 or num_sectors>max_hard_disk_num_sectors:
+                raise ValueError('invalid hard disk size: %d sectors'%num_sectors)
+    else:
+        format=g_adfs_formats.get(type)
+        if format is None: raise ValueError('unknown ADFS format: %s'%type)
+
+        if num_sectors is not None:
+            raise ValueError('size can only be specified for hard disk images')
+
+        num_sectors=format.num_sides*format.num_tracks*format.num_sectors
+
+    if boot_option<0 or boot_option>3:
+        raise ValueError("bad *OPT4 value: %s"%boot_option)
+
+    if disk_id<0 or disk_id>65535:
+        raise ValueError('invalid disk identifier: 0x%04x'%(disk_id))
+
+    builder=ADFSImageBuilder(root_dir,disk_id,boot_option,num_sectors)
+
+    image=builder.image
+    pv('%d bytes in %d files/%d dirs\n'%(image.num_bytes,
+                                         image.num_files,
+                                         image.num_dirs))
+    pv('%d sectors (%d bytes) used, of %d\n'%(image.num_used_sectors,
+                                              image.num_used_sectors*256,
+                                              image.num_sectors))
+
+    return builder
+
+def get_adfs_image_data(builder,type):
+    """get data for image laid out by BUILDER, in track order if
+    floppy disk format TYPE requires it, as a bytearray."""
+    data=builder.get_data()
+
+    format=g_adfs_formats.get(type.upper())
+    if format is None or format.num_sides==1: return data
+
+    # Track-interleave the sides, copying a track at a time.
+    track_size=format.num_sectors*256
+    side_size=format.num_tracks*track_size
+    src=memoryview(data)
+    data=bytearray(len(src))
+    offset=0
+    for track in range(format.num_tracks):
+        for side in range(format.num_sides):
+            begin=side*side_size+track*track_size
+            data[offset:offset+track_size]=src[begin:begin+track_size]
+            offset+=track_size
+
+    return data
+
+def create_adfs_image(files,title='',boot_option=0,disk_id=0,type='L',num_sectors=None):
+    """create ADFS disk image from FILES, an iterable of (name,load,
+    exec,attr,data) records (see bbc_inf.BBCFile). Files in $ go in the
+    root, and files in other DFS directories go in ADFS directories of
+    the same name. TYPE is a key in g_adfs_formats, or hard_disk_type
+    for a hard disk image of NUM_SECTORS sectors (None for just large
+    enough). Returns the image, in track order, as a bytearray. Raises
+    ValueError if the input is invalid."""
+    return get_adfs_image_data(create_adfs_image_builder(get_root_dir(files,title),
+                                                         boot_option,
+                                                         disk_id,
+                                                         type,
+                                                         num_sectors),
+                               type)
+
+##########################################################################
+##########################################################################
+
+def get_size(size_str):
+    """get size in sectors from SIZE_STR, a number of bytes with
+    optional K or M suffix."""
+    scale=1
+    if size_str[-1:].upper()=='K': scale=1024
+    elif size_str[-1:].upper()=='M': scale=1024*1024
+
+    if scale!=1: size_str=size_str[:-1]
+
+    try: size=int(size_str,0)*scale
+    except ValueError: fatal('invalid size: %s'%size_str)
+
+    return (size+255)//256
+
+##########################################################################
+##########################################################################
+
 def main(options):
     global g_verbose ; g_verbose=options.verbose
 
-    format=g_adfs_formats.get(options.type.upper())
-    if format is None: fatal('unknown ADFS format: %s'%options.type)
+    # adf_extract writes the root directory's title and boot option to
+    # the .inf file alongside the folder.
+    if options.tree_path is not None and options.dir is None:
+        inf=read_inf(os.path.normpath(options.tree_path)+'.inf')
+        if inf is not None:
+            fields,kvs=inf
+            if options.title is None and 'DIRTITLE' in kvs:
+                options.title=kvs['DIRTITLE'][:max_title_len]
+            if options.opt4 is None and 'OPT' in kvs:
+                options.opt4=int(kvs['OPT'])&3
 
     # *TITLE.
-    max_title_len=19
     if options.title is None:
         if options.dir is not None:
             title_path=os.path.join(options.dir,'.title')
@@ -458,9 +713,6 @@ def main(options):
                 with open(title_path,'rt') as f:
                     options.title=f.readlines()[0][:max_title_len]
         if options.title is None: options.title=''
-    else:
-        if len(options.title)>max_title_len:
-            fatal('title is too long - max %d chars'%max_title_len)
 
     # *OPT4
     if options.opt4 is None:
@@ -470,51 +722,81 @@ def main(options):
                 with open(opt4_path,'rb') as f:
                     options.opt4=int(f.read()[0])&3
         if options.opt4 is None: options.opt4=0
-    else:
-        if options.opt4<0 or options.opt4>3:
-            fatal("bad *OPT4 value: %s"%options.opt4)
 
-                
-    # Disk identifier.
-    if options.disk_id is None:
-        options.disk_id=ord(os.urandom(1))|ord(os.urandom(1))<<8
-    else:
-        if options.disk_id<0 or options.disk_id>65536:
-            fatal('invalid disk identifier: 0x%04x'%(options.disk_id))
-
-    beeb_files=find_beeb_files(options)
+    num_sectors=None
+    if options.size is not None: num_sectors=get_size(options.size)
 
-    root_dir=BeebDir(None,'$',options.title)
+    if options.tree_path is not None:
+        if len(options.fnames)>0: fatal('files can\'t be specified with --tree')
 
-    # Form ADFS tree structure.
-    for f in beeb_files:
-        if f.dir=='$': root_dir.add_file(f)
-        else:
-            d=root_dir.get_or_create_dir(f.dir)
-            d.add_file(f)
-
-    # Build ADFS image.
-    image=ADFSImageBuilder(root_dir,
-                           options.disk_id,
-                           options.opt4,
-                           format.num_sides*format.num_tracks*format.num_sectors).image
-
-    pv('%d bytes in %d files/%d dirs\n'%(image.num_bytes,
-                                         image.num_files,
-                                         image.num_dirs))
-    pv('%d sectors (%d bytes) used\n'%(image.num_used_sectors,
-                                       image.num_used_sectors*256))
+        # File data is read as the image is written.
+        try: root_dir=load_tree(options.tree_path,options.title,options)
+        except ValueError as e: fatal(str(e))
+    else:
+        beeb_files=find_beeb_files(options)
+
+        records=[bbc_inf.BBCFile(name='%s.%s'%(f.dir,f.name),
+                                 load=f.load_addr,
+                                 exec_=f.exec_addr,
+                                 attr=bbc_inf.LOCKED_ATTR if f.locked else 0,
+                                 data=f.data)
+                 for f in beeb_files]
+
+        try: root_dir=get_root_dir(records,options.title)
+        except ValueError as e: fatal(str(e))
+
+    # Hard disk images, and anything built from a --tree, are written
+    # straight to the output file, so memory use doesn't depend on the
+    # image size. They aren't cached.
+    if (options.type.upper()==hard_disk_type or
+        options.tree_path is not None):
+        if options.disk_id is None:
+            options.disk_id=ord(os.urandom(1))|ord(os.urandom(1))<<8
+
+        try:
+            builder=create_adfs_image_builder(root_dir,
+                                              options.opt4,
+                                              options.disk_id,
+                                              options.type,
+                                              num_sectors)
+            if options.output_path is not None:
+                with open(options.output_path,'wb') as f:
+                    if options.type.upper()==hard_disk_type: builder.write(f)
+                    else: f.write(get_adfs_image_data(builder,options.type))
+        except ValueError as e: fatal(str(e))
+
+        return
+
+    # A random disk identifier isn't part of the key: any previous
+    # random identifier is as good as a new one.
+    data=None
+    cache=image_cache.create_cache(options)
+    if cache is not None:
+        key=cache.get_key([__file__,adfs.__file__,bbc_inf.__file__],
+                          records,
+                          options.title,
+                          options.opt4,
+                          options.disk_id,
+                          options.type.upper())
+        data=cache.get(key)
+        if data is not None: pv('using cached image\n')
+
+    if data is None:
+        # Disk identifier.
+        if options.disk_id is None:
+            options.disk_id=ord(os.urandom(1))|ord(os.urandom(1))<<8
+
+        try:
+            data=get_adfs_image_data(create_adfs_image_builder(root_dir,
+                                                               options.opt4,
+                                                               options.disk_id,
+                                                               options.type,
+                                                               num_sectors),
+                                     options.type)
+        except ValueError as e: fatal(str(e))
+        if cache is not None: cache.put(key,data)
 
     if options.output_path is not None:
-        # Create output file data.
-        data=b''
-        for track in range(format.num_tracks):
-            for side in range(format.num_sides):
-                for sector in range(format.num_sectors):
-                    data+=image.sectors[side*(format.num_tracks*
-                                              format.num_sectors)+
-                                        track*format.num_sectors+
-                                        sector]
         with open(options.output_path,'wb') as f: f.write(data)
 
 ##########################################################################
@@ -542,6 +824,13 @@ if __name__=='__main__':
 
     parser.add_argument('--all-non-writeable',action='store_true',help='''add all files as non-writeable''')
 
+    parser.add_argument('--size',metavar='SIZE',default=None,help='with --type '+hard_disk_type+', make hard disk image %(metavar)s bytes (K or M suffix allowed). Default: just large enough')
+
+    parser.add_argument('--tree',dest='tree_path',metavar='PATH',default=None,help='''add files from folder tree %(metavar)s, as written by adf_extract, rather than from FILE list. Each PC folder becomes an ADFS directory. Images are written without caching, and file data is read as it's written, so memory use doesn't grow with image size''')
+
+    image_cache.add_arguments(parser)
+    inf_scan.add_arguments(parser)
+
     parser.add_argument('fnames',nargs='*',metavar='FILE',default=[],help='file(s) to put in disk image (non-BBC files will be ignored)')
 
     args=sys.argv[1:]
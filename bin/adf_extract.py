@@ -1,5 +1,5 @@
 #!/usr/bin/python3
-import os,os.path,sys,collections,argparse,glob,numbers,bbc_inf
+import os,os.path,sys,collections,argparse,glob,numbers,mmap,io,contextlib,multiprocessing,bbc_inf,adfs
 
 # see http://mdfs.net/Docs/Comp/Disk/Format/ADFS
 
@@ -55,28 +55,24 @@ def get_32le(data,offset):
 def bad_format(msg): fatal('bad ADFS format: %s'%msg)
 
 def check_hugo(data,offset,msg):
-    assert type(data)==bytes,type(data)
     if data[offset+0:offset+4]!=b'Hugo': bad_format('Hugo missing: %s'%msg)
 
 def check_checksum(data,what):
-    sum=255
-    for j in range(254,-1,-1):
-        if sum>255: sum=(sum+1)&0xff
-        sum+=data[j]
-    if (sum&0xff)!=data[255]:
-        bad_format('bad checksum for %s - expected $%02x, got $%02x'%(what,sum&0xff,data[255]))
+    sum=adfs.get_checksum(data)
+    if sum!=data[255]:
+        bad_format('bad checksum for %s - expected $%02x, got $%02x'%(what,sum,data[255]))
 
 class ADFSImage:
     def __init__(self,data,sequential,ignore_size_mismatch):
-        assert type(data)==bytes,type(data)
-        
         self.ignore_size_mismatch=ignore_size_mismatch
         
         if len(data)%256!=0:
             bad_format('data size not a multiple of 256 bytes')
+
+        self._data=memoryview(data)
             
-        check_checksum(data[0:256],'sector 0')
-        check_checksum(data[256:512],'sector 1')
+        check_checksum(self._data[0:256],'sector 0')
+        check_checksum(self._data[256:512],'sector 1')
 
         num_sectors=get_24le(data,0xfc)
         pv('%d sector(s) on disk\n'%num_sectors)
@@ -87,11 +83,12 @@ class ADFSImage:
                 warn('ignoring bad ADFS format: %s\n'%message)
             else: bad_format(message)
 
-        self._sectors=[]
-        if sequential:
-            for i in range(0,len(data),256):
-                self._sectors.append(data[i:i+256])
-        else:
+        self._num_sectors=len(data)//256
+
+        # logical sector -> offset in data. None if the image is in
+        # logical sector order.
+        self._sector_offsets=None
+        if not sequential:
             if len(data)%(16*256)!=0:
                 bad_format('track-interleaved data not a multiple of track size')
 
@@ -104,31 +101,72 @@ class ADFSImage:
             if format is None:
                 bad_format('unrecognised floppy disk size: %d sectors (%d bytes) (maybe try --sequential)'%(num_sectors,num_sectors*256))
 
-            for i in range(len(data)//256):
-                # logical sector order is tracks 0-(N-1) on side 0,
-                # then again on side 2.
-                sector=i%format.num_sectors
-                i//=format.num_sectors
-                
-                track=i%format.num_tracks
-                i//=format.num_tracks
+            # logical sector order is tracks 0-(N-1) on side 0, then
+            # again on side 2. ADFS images are track-interleaved.
+            self._sector_offsets=[((track*format.num_sides+side)*format.num_sectors+sector)*256
+                                  for side in range(format.num_sides)
+                                  for track in range(format.num_tracks)
+                                  for sector in range(format.num_sectors)]
+            del self._sector_offsets[self._num_sectors:]
 
-                side=i
-                assert side>=0 and side<format.num_sides
+    @property
+    def bootopt(self): return self._data[256+0xfd]
 
-                # ADFS images are track-interleaved.
-                offset=((track*format.num_sides+side)*format.num_sectors+sector)*256
+    @property
+    def num_sectors(self): return self._num_sectors
 
-                self._sectors.append(data[offset:offset+256])
+    def get_free_space(self):
+        """get free space map entries, as list of (sector,num_sectors)."""
+        end=self._data[256+0xfe]
+        if end%3!=0 or end>0xf6:
+            bad_format('bad free space map end pointer: $%02x'%end)
 
-    @property
-    def bootopt(self): return self._sectors[1][0xfd]
+        return [(get_24le(self._data,i),get_24le(self._data,256+i))
+                for i in range(0,end,3)]
+
+    def _get_sector_offset(self,sector):
+        if self._sector_offsets is None: return sector*256
+        else: return self._sector_offsets[sector]
 
     def get_sector(self,sector):
         assert sector>=0,sector
-        assert self.ignore_size_mismatch or sector<len(self._sectors),(sector,len(self._sectors))
-        if sector>=len(self._sectors): return None
-        return self._sectors[sector]
+        assert self.ignore_size_mismatch or sector<self._num_sectors,(sector,self._num_sectors)
+        if sector>=self._num_sectors: return None
+        offset=self._get_sector_offset(sector)
+        return self._data[offset:offset+256]
+
+    def get_views(self,sector,size):
+        """get list of memoryviews covering SIZE bytes starting at
+        logical sector SECTOR. Sectors adjacent in the image are
+        returned as one view. Returns None if the data runs past the
+        end of the image."""
+        views=[]
+        begin=None
+        end=None
+        while size>0:
+            if sector>=self._num_sectors: return None
+
+            offset=self._get_sector_offset(sector)
+            n=min(size,256)
+            if offset==end: end+=n
+            else:
+                if begin is not None: views.append(self._data[begin:end])
+                begin=offset
+                end=offset+n
+
+            sector+=1
+            size-=n
+
+        if begin is not None: views.append(self._data[begin:end])
+
+        return views
+
+    def read(self,sector,size):
+        """get SIZE bytes starting at logical sector SECTOR as bytes,
+        or None if the data runs past the end of the image."""
+        views=self.get_views(sector,size)
+        if views is None: return None
+        return b''.join(views)
             
 ##########################################################################
 ##########################################################################
@@ -158,17 +196,20 @@ def write_inf(inf_path,name,load,exec,size,attr,kvs):
 ##########################################################################
 ##########################################################################
 
-ExtractDirResult=collections.namedtuple('ExtractDirResult','title')
+# ADFS directory entry. R/W/L/D/E are the attribute bits; attr is
+# the .inf-style attribute byte. For a directory, sector is the
+# directory's first sector.
+ADFSEntry=collections.namedtuple('ADFSEntry','name R W L D E attr load_addr exec_addr size sector')
 
-def extract_dir(adf,
-                adfs_path,
-                dir_sector,
-                output_path):
-    pv('ADFS dir %s -> PC dir %s...\n'%('.'.join(adfs_path),
-                                        output_path))
-    
-    dir=bytes()
-    for i in range(5): dir+=adf.get_sector(dir_sector+i)
+ADFSDir=collections.namedtuple('ADFSDir','title entries')
+
+ROOT_DIR_SECTOR=2
+
+def read_dir(adf,adfs_path,dir_sector):
+    """read and check the directory ADFS_PATH (list of names) at
+    DIR_SECTOR, returning an ADFSDir."""
+    dir=adf.read(dir_sector,5*256)
+    if dir is None: bad_format('%s runs past end of image'%adfs_path)
 
     check_hugo(dir,1,'%s header'%adfs_path)
     check_hugo(dir,0x4fb,'%s footer'%adfs_path)
@@ -183,6 +224,7 @@ def extract_dir(adf,
 
     title=get_string(0x4d9,19)
 
+    entries=[]
     for file_idx in range(47):
         offset=5+file_idx*0x1a
 
@@ -200,102 +242,269 @@ def extract_dir(adf,
               (0x22 if W else 0)|
               (0x44 if E else 0)|
               (0x88 if L else 0))
-        
-        if D:
-            child_dir_sector=get_24le(dir,offset+0x16)
-            pc_path=os.path.join(output_path,
-                                 bbc_inf.get_pc_name(name))
-            result=extract_dir(adf,
-                               adfs_path+[name],
-                               child_dir_sector,
-                               pc_path)
-            # The attributes and size are what Disk Image Manager
-            # writes out.
-            write_inf('%s.inf'%pc_path,
-                      name,
-                      0,
-                      0,
-                      0x500,
-                      attr,
-                      {'DIRTITLE':result.title})
-        else:
-            load_addr=get_32le(dir,offset+0xa)
-            exec_addr=get_32le(dir,offset+0xe)
-            size=get_32le(dir,offset+0x12)
-            sector=get_24le(dir,offset+0x16)
 
-            pc_path=os.path.join(output_path,
-                                 bbc_inf.get_pc_name(name))
+        entries.append(ADFSEntry(name=name,
+                                 R=R,
+                                 W=W,
+                                 L=L,
+                                 D=D,
+                                 E=E,
+                                 attr=attr,
+                                 load_addr=get_32le(dir,offset+0xa),
+                                 exec_addr=get_32le(dir,offset+0xe),
+                                 size=get_32le(dir,offset+0x12),
+                                 sector=get_24le(dir,offset+0x16)))
+
+    return ADFSDir(title=title,entries=entries)
+
+def walk_dir(adf,adfs_path,dir_sector):
+    """generate (adfs_path,entry) for each entry in the directory
+    ADFS_PATH at DIR_SECTOR, and, recursively, its subdirectories,
+    depth first. Each directory is only read when the walk reaches
+    it."""
+    for entry in read_dir(adf,adfs_path,dir_sector).entries:
+        yield adfs_path,entry
+        if entry.D:
+            yield from walk_dir(adf,adfs_path+[entry.name],entry.sector)
+
+def find_entry(adf,path):
+    """find entry for ADFS path PATH (e.g., $.GAMES.ELITE), reading
+    only the directories along the way. Names are matched
+    case-insensitively. Returns (adfs_path,entry), adfs_path being
+    the list of names of the entry's parent directory, or None if not
+    found."""
+    names=path.split('.')
+    if names[0]!='$': fatal('ADFS path must start with $: %s'%path)
+    if len(names)==1: fatal('$ is not an entry: %s'%path)
+
+    adfs_path=['$']
+    dir_sector=ROOT_DIR_SECTOR
+    for i,name in enumerate(names[1:]):
+        entry=None
+        for e in read_dir(adf,adfs_path,dir_sector).entries:
+            if e.name.upper()==name.upper():
+                entry=e
+                break
+
+        if entry is None: return None
+
+        if i==len(names)-2: return adfs_path,entry
+
+        if not entry.D: return None
+
+        adfs_path=adfs_path+[entry.name]
+        dir_sector=entry.sector
 
-            adfs_path_str='.'.join(adfs_path+[name])
-            pv('ADFS file %s -> PC file %s\n'%(adfs_path_str,pc_path))
-            
-            pv('    (load=%08x exec=%08x size=%u attr=%02x (%s%s%s%s) sector=%06x)\n'%
-               (load_addr,
-                exec_addr,
-                size,
-                attr,
-                "R" if R else "",
-                "W" if W else "",
-                "E" if E else "",
-                "L" if L else "",
-                sector))
-
-            data=bytearray()
-            num_bytes_left=size
-            while num_bytes_left>0:
-                next_sector=adf.get_sector(sector)
-                if next_sector is None:
-                    warn('file "%s" runs past end of image - not extracting'%adfs_path_str)
-                    data=None
-                    break
-                    
-                if len(next_sector)>size: next_sector=next_sector[:size]
-                    
-                data+=next_sector
-                sector+=1
-                num_bytes_left-=256
-
-            if data is not None:
-                write_inf('%s.inf'%pc_path,
-                          name,
-                          load_addr,
-                          exec_addr,
-                          size,
-                          attr,
-                          {})
-
-                with open(pc_path,'wb') as f: f.write(data)
-
-    return ExtractDirResult(title=title)
+##########################################################################
+##########################################################################
+
+def extract_file(adf,adfs_path,entry,pc_path):
+    adfs_path_str='.'.join(adfs_path+[entry.name])
+    pv('ADFS file %s -> PC file %s\n'%(adfs_path_str,pc_path))
+
+    pv('    (load=%08x exec=%08x size=%u attr=%02x (%s%s%s%s) sector=%06x)\n'%
+       (entry.load_addr,
+        entry.exec_addr,
+        entry.size,
+        entry.attr,
+        "R" if entry.R else "",
+        "W" if entry.W else "",
+        "E" if entry.E else "",
+        "L" if entry.L else "",
+        entry.sector))
+
+    views=adf.get_views(entry.sector,entry.size)
+    if views is None:
+        warn('file "%s" runs past end of image - not extracting'%adfs_path_str)
+    else:
+        write_inf('%s.inf'%pc_path,
+                  entry.name,
+                  entry.load_addr,
+                  entry.exec_addr,
+                  entry.size,
+                  entry.attr,
+                  {})
+
+        with open(pc_path,'wb') as f:
+            for view in views: f.write(view)
+
+ExtractDirResult=collections.namedtuple('ExtractDirResult','title')
+
+def extract_dir(adf,
+                adfs_path,
+                dir_sector,
+                output_path):
+    pv('ADFS dir %s -> PC dir %s...\n'%('.'.join(adfs_path),
+                                        output_path))
+
+    dir=read_dir(adf,adfs_path,dir_sector)
+
+    for entry in dir.entries:
+        pc_path=os.path.join(output_path,
+                             bbc_inf.get_pc_name(entry.name))
+        
+        if entry.D: extract_dir_entry(adf,adfs_path,entry,pc_path)
+        else: extract_file(adf,adfs_path,entry,pc_path)
+
+    return ExtractDirResult(title=dir.title)
+
+def extract_dir_entry(adf,adfs_path,entry,pc_path):
+    result=extract_dir(adf,
+                       adfs_path+[entry.name],
+                       entry.sector,
+                       pc_path)
+    # The attributes and size are what Disk Image Manager
+    # writes out.
+    write_inf('%s.inf'%pc_path,
+              entry.name,
+              0,
+              0,
+              0x500,
+              entry.attr,
+              {'DIRTITLE':result.title})
             
 ##########################################################################
 ##########################################################################
 
+def load_adfs_image(path,sequential,ignore_size_mismatch):
+    """load ADFS image from file, memory mapped, so only the sectors
+    actually used get read."""
+    with open(path,'rb') as f:
+        if os.fstat(f.fileno()).st_size==0: bad_format('empty file')
+        data=mmap.mmap(f.fileno(),0,access=mmap.ACCESS_READ)
+
+    return ADFSImage(data,sequential,ignore_size_mismatch)
+
 def adf_extract(options):
     global g_verbose ; g_verbose=options.verbose
 
     # try to make a folder named after the input file.
     input_basename=os.path.splitext(os.path.basename(options.input_path))[0]
 
-    with open(options.input_path,'rb') as f:
-        adf=ADFSImage(f.read(),
-                      options.sequential,
-                      options.ignore_size_mismatch)
+    adf=load_adfs_image(options.input_path,
+                        options.sequential,
+                        options.ignore_size_mismatch)
+
+    if options.adfs_path is None or options.adfs_path=='$':
+        adfs_path=['$']
+        entry=None
+        dir_sector=ROOT_DIR_SECTOR
+    else:
+        found=find_entry(adf,options.adfs_path)
+        if found is None: fatal('not found: %s'%options.adfs_path)
+        adfs_path,entry=found
+        dir_sector=entry.sector
+
+    if options.list:
+        if entry is not None and not entry.D: entries=[(adfs_path,entry)]
+        else:
+            if entry is not None: adfs_path=adfs_path+[entry.name]
+            entries=walk_dir(adf,adfs_path,dir_sector)
+
+        for path,e in entries:
+            print('%-30s %08x %08x %08x %02x%s'%('.'.join(path+[e.name]),
+                                                e.load_addr,
+                                                e.exec_addr,
+                                                e.size,
+                                                e.attr,
+                                                ' (dir)' if e.D else ''))
+    elif entry is None:
+        root_path=os.path.join(options.output_path,input_basename)
+        result=extract_dir(adf,adfs_path,dir_sector,root_path)
+
+        write_inf('%s.inf'%root_path,
+                  input_basename,
+                  0,
+                  0,
+                  0x500,
+                  0x99,
+                  {
+                      'DIRTITLE':result.title,
+                      'OPT':adf.bootopt,
+                  })
+    else:
+        pc_path=os.path.join(options.output_path,
+                             bbc_inf.get_pc_name(entry.name))
+        if entry.D: extract_dir_entry(adf,adfs_path,entry,pc_path)
+        else:
+            if not os.path.isdir(options.output_path):
+                os.makedirs(options.output_path)
+            extract_file(adf,adfs_path,entry,pc_path)
 
-    root_path=os.path.join(options.output_path,input_basename)
-    result=extract_dir(adf,['$'],2,root_path)
+##########################################################################
+##########################################################################
+    
+def verify(adf):
+    """check every directory's Hugo markers, and that every file and
+    directory lies within the image and outside the free space. (The
+    free space map checksums are checked when the ADFSImage is
+    created.) Problems are reported with bad_format."""
+    free_space=adf.get_free_space()
+    for sector,num_sectors in free_space:
+        if sector+num_sectors>adf.num_sectors:
+            bad_format('free space map entry runs past end of image: $%06x+$%06x'%(sector,num_sectors))
+
+    def check_extent(what,sector,num_sectors):
+        if sector+num_sectors>adf.num_sectors:
+            bad_format('%s runs past end of image'%what)
+
+        for free_sector,free_num_sectors in free_space:
+            if (sector<free_sector+free_num_sectors and
+                free_sector<sector+num_sectors):
+                bad_format('%s overlaps free space at $%06x'%(what,free_sector))
+
+    check_extent('$',ROOT_DIR_SECTOR,5)
+
+    # walk_dir checks each directory's Hugo markers as it goes.
+    for adfs_path,entry in walk_dir(adf,['$'],ROOT_DIR_SECTOR):
+        what='.'.join(adfs_path+[entry.name])
+        if entry.D: check_extent(what,entry.sector,5)
+        else: check_extent(what,entry.sector,(entry.size+255)//256)
+
+def verify_image(path,options):
+    """verify image at PATH. Returns (path,error), error being None if
+    the image is OK."""
+    errors=io.StringIO()
+    try:
+        with contextlib.redirect_stderr(errors):
+            verify(load_adfs_image(path,
+                                   options.sequential,
+                                   options.ignore_size_mismatch))
+    except SystemExit: return path,errors.getvalue().strip()
+    except Exception as e: return path,'%s: %s'%(type(e).__name__,e)
+
+    return path,None
+
+def _verify_image_worker(args): return verify_image(*args)
+
+def verify_images(options):
+    global g_verbose ; g_verbose=options.verbose
 
-    write_inf('%s.inf'%root_path,
-              input_basename,
-              0,
-              0,
-              0x500,
-              0x99,
-              {
-                  'DIRTITLE':result.title,
-                  'OPT':adf.bootopt,
-              })
+    num_jobs=options.jobs
+    if num_jobs is None: num_jobs=os.cpu_count() or 1
+    num_jobs=max(1,min(num_jobs,len(options.input_paths)))
+
+    jobs=[(path,options) for path in options.input_paths]
+
+    num_bad=0
+    def handle_result(path,error):
+        nonlocal num_bad
+        if error is None: pv('OK: %s\n'%path)
+        else:
+            sys.stderr.write('BAD: %s: %s\n'%(path,error))
+            num_bad+=1
+
+    if num_jobs==1:
+        for job in jobs: handle_result(*verify_image(*job))
+    else:
+        with multiprocessing.Pool(num_jobs) as pool:
+            for result in pool.imap_unordered(_verify_image_worker,
+                                              jobs,
+                                              chunksize=max(1,min(64,len(jobs)//(num_jobs*4)))):
+                handle_result(*result)
+
+    pv('%d/%d image(s) OK\n'%(len(jobs)-num_bad,len(jobs)))
+    if num_bad>0: fatal('%d/%d image(s) failed verification'%(num_bad,len(jobs)))
 
 ##########################################################################
 ##########################################################################
@@ -311,9 +520,23 @@ def main(args):
 
     parser.add_argument('--ignore-size-mismatch',action='store_true',help='''ignore mismatch between ADFS volume size and actual disk image size''')
 
-    parser.add_argument('input_path',metavar='FILE',help='read disk image from %(metavar)s')
+    parser.add_argument('-p','--path',dest='adfs_path',metavar='ADFS-PATH',default=None,help='''only extract %(metavar)s (e.g., $.GAMES.ELITE), a file or directory, reading only the directories needed to find it''')
+
+    parser.add_argument('-l','--list',action='store_true',help='''list entries (under ADFS-PATH, if specified) rather than extracting them''')
+
+    parser.add_argument('--verify',action='store_true',help='''check disk image(s) for problems (directory structure, free space map, file extents) rather than extracting them''')
+
+    parser.add_argument('-j','--jobs',type=int,default=None,metavar='N',help='''with --verify, use %(metavar)s worker processes. Default: one per CPU''')
+
+    parser.add_argument('input_paths',nargs='+',metavar='FILE',help='read disk image(s) from %(metavar)s')
+
+    options=parser.parse_args(args)
 
-    adf_extract(parser.parse_args(args))
+    if options.verify: verify_images(options)
+    else:
+        for input_path in options.input_paths:
+            options.input_path=input_path
+            adf_extract(options)
 
 ##########################################################################
 ##########################################################################
@@ -0,0 +1,21 @@
+##########################################################################
+##########################################################################
+
+# see http://mdfs.net/Docs/Comp/Disk/Format/ADFS
+
+##########################################################################
+##########################################################################
+
+def get_checksum(data):
+    '''get ADFS free space map checksum for 256-byte sector DATA.
+
+The checksum is the sum of bytes 254...0, starting from 255, with the
+carry from each 8-bit add fed into the next one, but the final carry
+discarded. Feeding the carries back in makes all but the last add an
+end-around carry sum, which is the total mod 255 (as 1-255), so that
+bit can be done with sum.'''
+    partial=(254+sum(data[1:255]))%255+1
+    return (partial+data[0])&0xff
+
+##########################################################################
+##########################################################################
@@ -1,3 +1,5 @@
+import collections
+
 ##########################################################################
 ##########################################################################
 
@@ -19,3 +21,16 @@ When using this for a DFS-style name, use it separately for the directory char a
 
 ##########################################################################
 ##########################################################################
+
+# A BBC file held in memory, as described by a .inf file: NAME is the
+# full BBC name (e.g., $.!BOOT), LOAD and EXEC_ the addresses, ATTR
+# the attribute byte (bit 3 set if locked), and DATA the contents.
+#
+# The disc image creation functions take any iterable of 5-tuples in
+# this order, so plain tuples will do too.
+BBCFile=collections.namedtuple('BBCFile','name load exec_ attr data')
+
+LOCKED_ATTR=0x08
+
+##########################################################################
+##########################################################################
@@ -0,0 +1,368 @@
+#!/usr/bin/python3
+import sys,os,os.path,argparse,collections,hashlib,sqlite3,io,contextlib,multiprocessing
+import ssd_extract,adf_extract,mmb
+
+##########################################################################
+##########################################################################
+
+# Index of the files in an archive of disc images, stored in an SQLite
+# database.
+#
+# Each image is recorded with its mtime and size, and is only
+# re-scanned when either changes. Each file in each image is recorded
+# with its metadata and a SHA-256 hash of its contents, so finding
+# which images contain a given file, or a given binary, is a database
+# query.
+
+##########################################################################
+##########################################################################
+
+def fatal(str):
+    sys.stderr.write('FATAL: %s'%str)
+    if str[-1]!='\n': sys.stderr.write('\n')
+
+    sys.exit(1)
+
+##########################################################################
+##########################################################################
+
+g_verbose=False
+
+def pv(str):
+    global g_verbose
+
+    if g_verbose:
+        sys.stdout.write(str)
+        sys.stdout.flush()
+
+##########################################################################
+##########################################################################
+
+SCHEMA_VERSION=1
+
+dfs_exts=['.ssd','.dsd']
+adfs_exts=['.adf','.adl']
+mmb_exts=['.mmb']
+image_exts=dfs_exts+adfs_exts+mmb_exts
+
+# SLOT is the MMB disk index, or None; SIDE is 0 or 1 for DFS discs,
+# or None; NAME is the full BBC name (e.g., $.ELITE or $.GAMES.ELITE);
+# SHA256 is the hex hash of the contents, or None if the file runs past
+# the end of the image.
+IndexEntry=collections.namedtuple('IndexEntry','slot side name load exec_ length sector attr sha256')
+
+IndexResult=collections.namedtuple('IndexResult','path entries error')
+
+##########################################################################
+##########################################################################
+
+def get_sha256(views):
+    hasher=hashlib.sha256()
+    for view in views: hasher.update(view)
+    return hasher.hexdigest()
+
+def get_dfs_entries(disc,slot):
+    entries=[]
+    for side in range(disc.num_sides):
+        for e in disc.get_catalogue(side):
+            try: sha256=get_sha256(disc.get_file_views(side,e.start,e.length))
+            except IndexError: sha256=None
+
+            entries.append(IndexEntry(slot=slot,
+                                      side=side,
+                                      name='%s.%s'%(e.dir,e.name),
+                                      load=e.load,
+                                      exec_=e.exec_,
+                                      length=e.length,
+                                      sector=e.start,
+                                      attr=0x08 if e.locked else 0,
+                                      sha256=sha256))
+
+    return entries
+
+def get_adfs_entries(adf):
+    entries=[]
+    for adfs_path,e in adf_extract.walk_dir(adf,['$'],adf_extract.ROOT_DIR_SECTOR):
+        if e.D: continue
+
+        views=adf.get_views(e.sector,e.size)
+        entries.append(IndexEntry(slot=None,
+                                  side=None,
+                                  name='.'.join(adfs_path+[e.name]),
+                                  load=e.load_addr,
+                                  exec_=e.exec_addr,
+                                  length=e.size,
+                                  sector=e.sector,
+                                  attr=e.attr,
+                                  sha256=None if views is None else get_sha256(views)))
+
+    return entries
+
+def get_entries(path):
+    ext=os.path.splitext(path)[1].lower()
+    if ext in dfs_exts:
+        disc=ssd_extract.open_image(path)
+        return get_dfs_entries(disc,None)
+    elif ext in adfs_exts:
+        # floppy images are track-interleaved, but try logical sector
+        # order if this doesn't look like a floppy.
+        try:
+            with contextlib.redirect_stderr(io.StringIO()):
+                adf=adf_extract.load_adfs_image(path,False,False)
+        except SystemExit: adf=adf_extract.load_adfs_image(path,True,False)
+
+        return get_adfs_entries(adf)
+    elif ext in mmb_exts:
+        m=mmb.load_mmb_from_file(path)
+        entries=[]
+        for i in range(511):
+            if m.get_disk_type(i) in [mmb.TYPE_RO,mmb.TYPE_RW]:
+                entries+=get_dfs_entries(ssd_extract.Disc(1,80,10,m.get_disk_contents(i)),i)
+        return entries
+    else: raise ValueError('unrecognised extension: %s'%ext)
+
+def index_image(path):
+    """index the files in disc image PATH. Result is an IndexResult,
+    with error set (to the FATAL message, or exception text) if the
+    image couldn't be read."""
+    entries=[]
+    errors=io.StringIO()
+    error=None
+    try:
+        with contextlib.redirect_stdout(io.StringIO()),contextlib.redirect_stderr(errors):
+            entries=get_entries(path)
+    except SystemExit as e: error=errors.getvalue().strip() or 'exit code %s'%e.code
+    except Exception as e: error='%s: %s'%(type(e).__name__,e)
+
+    return IndexResult(path=path,entries=entries,error=error)
+
+##########################################################################
+##########################################################################
+
+def open_db(path):
+    db=sqlite3.connect(path)
+    version=db.execute('PRAGMA user_version').fetchone()[0]
+    if version==0:
+        db.executescript('''
+CREATE TABLE images(id INTEGER PRIMARY KEY,path TEXT UNIQUE NOT NULL,mtime_ns INTEGER NOT NULL,size INTEGER NOT NULL,error TEXT);
+CREATE TABLE files(image_id INTEGER NOT NULL REFERENCES images(id) ON DELETE CASCADE,slot INTEGER,side INTEGER,name TEXT NOT NULL,leaf TEXT NOT NULL,load INTEGER,exec INTEGER,length INTEGER,sector INTEGER,attr INTEGER,sha256 TEXT);
+CREATE INDEX files_image_id ON files(image_id);
+CREATE INDEX files_leaf ON files(leaf COLLATE NOCASE);
+CREATE INDEX files_sha256 ON files(sha256);
+PRAGMA user_version=%d;
+'''%SCHEMA_VERSION)
+    elif version!=SCHEMA_VERSION:
+        fatal('%s: unsupported index version: %d'%(path,version))
+
+    db.execute('PRAGMA foreign_keys=ON')
+    return db
+
+def find_image_paths(paths):
+    """get tuple of (list of (path,os.stat result) for the disc images
+    in PATHS, folders being searched; list of (path,error message) for
+    images found in folders that couldn't be stat'd). PATHS that can't
+    be stat'd are fatal, as everything indexed under them would
+    otherwise be removed."""
+    result=[]
+    errors=[]
+    for path in paths:
+        if os.path.isdir(path):
+            for dirpath,dirnames,filenames in os.walk(path):
+                dirnames.sort()
+                for filename in sorted(filenames):
+                    if os.path.splitext(filename)[1].lower() in image_exts:
+                        image_path=os.path.abspath(os.path.join(dirpath,filename))
+                        try: result.append((image_path,os.stat(image_path)))
+                        except OSError as e: errors.append((image_path,e.strerror))
+        else:
+            image_path=os.path.abspath(path)
+            try: result.append((image_path,os.stat(image_path)))
+            except OSError as e: fatal('%s: %s'%(path,e.strerror))
+
+    return result,errors
+
+def is_under(path,roots):
+    for root in roots:
+        if path==root or path.startswith(os.path.join(root,'')): return True
+    return False
+
+def update_cmd(options):
+    global g_verbose ; g_verbose=options.verbose
+
+    images,stat_errors=find_image_paths(options.paths)
+    for path,error in stat_errors:
+        sys.stderr.write('ERROR: %s: %s\n'%(path,error))
+
+    db=open_db(options.db_path)
+
+    roots=[os.path.abspath(path) for path in options.paths]
+
+    # path -> (id,mtime_ns,size)
+    known={}
+    for id,path,mtime_ns,size in db.execute('SELECT id,path,mtime_ns,size FROM images'):
+        if is_under(path,roots): known[path]=(id,mtime_ns,size)
+
+    jobs=[]
+    for path,st in images:
+        old=known.pop(path,None)
+        if old is not None and old[1]==st.st_mtime_ns and old[2]==st.st_size:
+            continue
+        jobs.append((path,st))
+
+    # anything left wasn't found this time.
+    with db:
+        for path,(id,mtime_ns,size) in known.items():
+            pv('removed: %s\n'%path)
+            db.execute('DELETE FROM images WHERE id=?',(id,))
+
+    num_jobs=options.jobs
+    if num_jobs is None: num_jobs=os.cpu_count() or 1
+    num_jobs=max(1,min(num_jobs,len(jobs)))
+
+    stat_by_path=dict(jobs)
+    num_failed=len(stat_errors)
+    num_files=0
+
+    def handle_result(result):
+        nonlocal num_failed,num_files
+        st=stat_by_path[result.path]
+
+        pv('%s: %d file(s)\n'%(result.path,len(result.entries)))
+        if result.error is not None:
+            sys.stderr.write('ERROR: %s: %s\n'%(result.path,result.error))
+            num_failed+=1
+
+        db.execute('DELETE FROM images WHERE path=?',(result.path,))
+        id=db.execute('INSERT INTO images(path,mtime_ns,size,error) VALUES (?,?,?,?)',
+                      (result.path,st.st_mtime_ns,st.st_size,result.error)).lastrowid
+        db.executemany('INSERT INTO files(image_id,slot,side,name,leaf,load,exec,length,sector,attr,sha256) VALUES (?,?,?,?,?,?,?,?,?,?,?)',
+                       [(id,
+                         e.slot,
+                         e.side,
+                         e.name,
+                         e.name.split('.')[-1],
+                         e.load,
+                         e.exec_,
+                         e.length,
+                         e.sector,
+                         e.attr,
+                         e.sha256) for e in result.entries])
+        num_files+=len(result.entries)
+
+    paths=[path for path,st in jobs]
+    with db:
+        if num_jobs<=1:
+            for path in paths: handle_result(index_image(path))
+        else:
+            with multiprocessing.Pool(num_jobs) as pool:
+                for result in pool.imap_unordered(index_image,
+                                                  paths,
+                                                  chunksize=max(1,min(64,len(paths)//(num_jobs*4)))):
+                    handle_result(result)
+
+    db.close()
+
+    print('%d image(s) indexed (%d file(s)), %d unchanged, %d removed, %d failed'%(len(jobs),
+                                                                                 num_files,
+                                                                                 len(images)-len(jobs),
+                                                                                 len(known),
+                                                                                 num_failed))
+
+##########################################################################
+##########################################################################
+
+def get_like_pattern(pattern):
+    """convert glob-style PATTERN to an SQL LIKE pattern, with \\ as
+    escape char."""
+    like=''
+    for c in pattern:
+        if c=='*': like+='%'
+        elif c=='?': like+='_'
+        elif c in '%_\\': like+='\\'+c
+        else: like+=c
+    return like
+
+def print_rows(rows):
+    for path,slot,side,name,load,exec_,length,sector,attr,sha256 in rows:
+        location=path
+        if slot is not None: location+='#%03d'%slot
+        if side is not None: location+=':%d'%(side*2)
+
+        print('%s: %-12s %08x %08x %08x %s'%(location,
+                                               name,
+                                               load,
+                                               exec_,
+                                               length,
+                                               sha256 or '-'))
+
+select_files='SELECT images.path,slot,side,name,load,exec,length,sector,attr,sha256 FROM files JOIN images ON files.image_id=images.id '
+
+def find_cmd(options):
+    db=open_db(options.db_path)
+    for pattern in options.patterns:
+        # match the whole name if there's a directory, or just the
+        # last part otherwise.
+        column='name' if '.' in pattern else 'leaf'
+        print_rows(db.execute(select_files+'WHERE %s LIKE ? ESCAPE \'\\\' ORDER BY images.path,slot,side,name'%column,
+                              (get_like_pattern(pattern),)))
+    db.close()
+
+def find_data_cmd(options):
+    db=open_db(options.db_path)
+    for path in options.paths:
+        with open(path,'rb') as f: sha256=get_sha256([f.read()])
+        print_rows(db.execute(select_files+'WHERE sha256=? ORDER BY images.path,slot,side,name',
+                              (sha256,)))
+    db.close()
+
+def stats_cmd(options):
+    db=open_db(options.db_path)
+    num_images,num_failed=db.execute('SELECT COUNT(*),COUNT(error) FROM images').fetchone()
+    num_files,num_unique=db.execute('SELECT COUNT(*),COUNT(DISTINCT sha256) FROM files').fetchone()
+    print('%d image(s) (%d failed), %d file(s) (%d unique)'%(num_images,num_failed,num_files,num_unique))
+
+    if options.errors:
+        for path,error in db.execute('SELECT path,error FROM images WHERE error IS NOT NULL ORDER BY path'):
+            print('%s: %s'%(path,error))
+
+    db.close()
+
+##########################################################################
+##########################################################################
+
+def main(argv):
+    parser=argparse.ArgumentParser(description='index the files in an archive of disc images')
+    parser.add_argument('-v','--verbose',action='store_true',help='''be more verbose''')
+    parser.set_defaults(fun=None)
+    subparsers=parser.add_subparsers()
+
+    def add_subparser(fun,name,**kwargs):
+        subparser=subparsers.add_parser(name,**kwargs)
+        subparser.set_defaults(fun=fun)
+        subparser.add_argument('db_path',metavar='DB',help='''use index database %(metavar)s''')
+        return subparser
+
+    update_parser=add_subparser(update_cmd,'update',help='''add new or changed disc images to index, and remove deleted ones''')
+    update_parser.add_argument('-j','--jobs',metavar='N',type=int,default=None,help='''scan images using %(metavar)s processes. Default: one per CPU''')
+    update_parser.add_argument('paths',nargs='+',metavar='PATH',help='''disc image (.ssd, .dsd, .adf, .adl, .mmb), or folder to search for disc images''')
+
+    find_parser=add_subparser(find_cmd,'find',help='''find images containing BBC file(s)''')
+    find_parser.add_argument('patterns',nargs='+',metavar='NAME',help='''BBC name to look for (case-insensitive, * and ? wildcards allowed). Name with no directory matches in any directory''')
+
+    find_data_parser=add_subparser(find_data_cmd,'find-data',help='''find images containing copies of PC file(s)''')
+    find_data_parser.add_argument('paths',nargs='+',metavar='FILE',help='''PC file whose contents to look for''')
+
+    stats_parser=add_subparser(stats_cmd,'stats',help='''print index stats''')
+    stats_parser.add_argument('--errors',action='store_true',help='''list images that couldn't be read''')
+
+    options=parser.parse_args(argv)
+    if options.fun is None:
+        parser.print_help()
+        sys.exit(1)
+
+    options.fun(options)
+
+##########################################################################
+##########################################################################
+
+if __name__=='__main__': main(sys.argv[1:])
@@ -4,47 +4,162 @@ import sys,os,os.path,argparse
 ##########################################################################
 ##########################################################################
 
-def main2(options):
-    track_size_bytes=10*256
-    
-    def load_ssd(path):
-        if path is None:
-            data=bytearray(512)
-            # 80*10=800=0x320
-            data[0x106]=0x03
-            data[0x107]=0x02
-        else:
-            with open(path,'rb') as f: data=f.read()
-
-            if len(data)>80*track_size_bytes:
-                sys.stderr.write(f'''WARNING: file larger than 80 tracks will be truncated: {path}\n''')
-
-        return data
-
-    side0=load_ssd(options.side0_path)
-    side2=load_ssd(options.side2_path)
-
-    dsd=bytes()
-
-    def get_track(ssd,offset):
-        if offset>len(ssd): track=b''
-        else: track=ssd[offset:offset+track_size_bytes]
-        
-        if len(track)<track_size_bytes:
-            track+=b'\xe5'*(track_size_bytes-len(track))
-            
-        return track
-
-    for track in range(0,80):
+def fatal(str):
+    sys.stderr.write("FATAL: %s"%str)
+    if str[-1]!='\n': sys.stderr.write("\n")
+
+    sys.exit(1)
+
+##########################################################################
+##########################################################################
+
+track_size_bytes=10*256
+
+blank_track=b'\xe5'*track_size_bytes
+
+def get_blank_ssd():
+    data=bytearray(512)
+    # 80*10=800=0x320
+    data[0x106]=0x03
+    data[0x107]=0x02
+    return data
+
+def get_num_tracks(side0,side2):
+    """number of tracks in .dsd image made from .ssd images SIDE0 and
+    SIDE2."""
+    size=max(len(side0),len(side2))
+    return min(80,size//track_size_bytes+1)
+
+def get_tracks(side0,side2):
+    """generate the tracks of .dsd image made from .ssd images SIDE0
+    and SIDE2 (blank 80T if None), in order. Tracks are memoryview
+    slices of the inputs, where possible."""
+    if side0 is None: side0=get_blank_ssd()
+    if side2 is None: side2=get_blank_ssd()
+
+    sides=[memoryview(side0),memoryview(side2)]
+
+    for track in range(get_num_tracks(side0,side2)):
         offset=track*track_size_bytes
+        for side in sides:
+            data=side[offset:offset+track_size_bytes]
+            yield data
+            if len(data)<track_size_bytes:
+                yield blank_track[len(data):]
+
+def create_dsd_image(side0,side2):
+    """create .dsd image from .ssd images SIDE0 and SIDE2 (blank 80T
+    if None). Use ssd_create.create_ssd_image to make each side from
+    BBC files. Returns the image as a bytearray."""
+    if side0 is None: side0=get_blank_ssd()
+    if side2 is None: side2=get_blank_ssd()
+
+    dsd=bytearray(get_num_tracks(side0,side2)*2*track_size_bytes)
+    offset=0
+    for data in get_tracks(side0,side2):
+        dsd[offset:offset+len(data)]=data
+        offset+=len(data)
+
+    return dsd
+
+def write_dsd_image(f,side0,side2):
+    """write .dsd image made from .ssd images SIDE0 and SIDE2 (blank
+    80T if None) to file F, a track at a time."""
+    for data in get_tracks(side0,side2): f.write(data)
+
+##########################################################################
+##########################################################################
+
+def get_side_tracks(dsd,side):
+    """generate the tracks of side SIDE (0 or 1) of .dsd image DSD, as
+    memoryview slices."""
+    dsd=memoryview(dsd)
+    for offset in range(side*track_size_bytes,
+                        len(dsd),
+                        2*track_size_bytes):
+        yield dsd[offset:offset+track_size_bytes]
+
+def split_dsd_image(dsd):
+    """split .dsd image DSD into two .ssd images, one per side.
+    Returns tuple of (side 0,side 2), each a bytearray."""
+    return tuple(bytearray().join(get_side_tracks(dsd,side))
+                 for side in range(2))
+
+##########################################################################
+##########################################################################
+
+def load_ssd(path):
+    if path is None: return None
+
+    with open(path,'rb') as f: data=f.read()
 
-        if offset>len(side0) and offset>len(side2): break
+    if len(data)>80*track_size_bytes:
+        sys.stderr.write(f'''WARNING: file larger than 80 tracks will be truncated: {path}\n''')
 
-        dsd+=get_track(side0,offset)
-        dsd+=get_track(side2,offset)
+    return data
 
-    if options.output_path is not None:
-        with open(options.output_path,'wb') as f: f.write(dsd)
+def create_dsd_file(side0_path,side2_path,output_path):
+    side0=load_ssd(side0_path)
+    side2=load_ssd(side2_path)
+
+    if output_path is not None:
+        with open(output_path,'wb') as f: write_dsd_image(f,side0,side2)
+
+def split_dsd_file(dsd_path,side0_path,side2_path):
+    with open(dsd_path,'rb') as f: dsd=f.read()
+
+    for side,path in enumerate([side0_path,side2_path]):
+        if path is not None:
+            with open(path,'wb') as f:
+                for data in get_side_tracks(dsd,side): f.write(data)
+
+##########################################################################
+##########################################################################
+
+def load_batch_jobs(path):
+    """load list of batch jobs from PATH (- for stdin): one per line,
+    SIDE0 SIDE2 DSD, with - for a blank/ignored side."""
+    if path=='-': f=sys.stdin
+    else: f=open(path,'rt')
+
+    jobs=[]
+    for line_idx,line in enumerate(f):
+        parts=line.split()
+        if len(parts)==0: continue
+        if len(parts)!=3: fatal('%s:%d: expected 3 paths, got %d'%(path,line_idx+1,len(parts)))
+
+        if parts[2]=='-': fatal('%s:%d: DSD path must be specified'%(path,line_idx+1))
+
+        jobs.append([None if part=='-' else part for part in parts])
+
+    if f is not sys.stdin: f.close()
+
+    return jobs
+
+def batch_main(options):
+    jobs=load_batch_jobs(options.batch_path)
+
+    failures=[]
+    for side0_path,side2_path,dsd_path in jobs:
+        try:
+            if options.split: split_dsd_file(dsd_path,side0_path,side2_path)
+            else: create_dsd_file(side0_path,side2_path,dsd_path)
+        except OSError as e:
+            sys.stderr.write('ERROR: %s: %s\n'%(dsd_path,e))
+            failures.append(dsd_path)
+
+    if len(failures)>0:
+        sys.stderr.write("%d/%d job(s) failed\n"%(len(failures),len(jobs)))
+        sys.exit(1)
+
+def main2(options):
+    if options.batch_path is not None: batch_main(options)
+    elif options.split: split_dsd_file(options.output_path,
+                                       options.side0_path,
+                                       options.side2_path)
+    else: create_dsd_file(options.side0_path,
+                          options.side2_path,
+                          options.output_path)
 
 ##########################################################################
 ##########################################################################
@@ -55,8 +170,20 @@ def main(argv):
     parser.add_argument('-0',metavar='FILE',dest='side0_path',help='''use .ssd file %(metavar)s for side 0 (blank 80T if not specified)''')
     parser.add_argument('-2',metavar='FILE',dest='side2_path',help='''use .ssd file %(metavar)s for side 2 (blank 80T if not specified)''')
     parser.add_argument('-o',metavar='FILE',dest='output_path',help='''write output .dsd file to %(metavar)s''')
- 
-    main2(parser.parse_args(argv))
+    parser.add_argument('--split',action='store_true',help='''work in reverse: split .dsd file given by -o into .ssd files given by -0 and/or -2''')
+    parser.add_argument('--batch',metavar='FILE',dest='batch_path',help='''read jobs from %(metavar)s (- for stdin), one per line: SIDE0 SIDE2 DSD, using - for a blank side. Failed jobs don't stop the others''')
+
+    options=parser.parse_args(argv)
+
+    if options.batch_path is not None:
+        if (options.side0_path is not None or
+            options.side2_path is not None or
+            options.output_path is not None):
+            parser.error('-0, -2 and -o are not valid with --batch')
+    elif options.split and options.output_path is None:
+        parser.error('--split requires -o')
+
+    main2(options)
 
 ##########################################################################
 ##########################################################################
@@ -0,0 +1,205 @@
+#!/usr/bin/python3
+import sys,os,os.path,argparse,hashlib,tempfile,collections
+
+##########################################################################
+##########################################################################
+
+# Content-addressed cache for generated disc images.
+#
+# The key for an image is a hash of the source of the tool that made
+# it and the modules it uses that affect the image data, the BBC
+# files that went in (contents and .inf metadata) and whichever
+# options affect the output. Images are stored as KEY.img files in
+# the cache folder, with the mtime updated on each hit, so the least
+# recently used images can be discarded when the cache gets too big.
+#
+# Each lookup appends a byte to stats.log in the cache folder - H for
+# a hit, M for a miss - so stats accumulate across runs.
+
+##########################################################################
+##########################################################################
+
+def warn(msg): sys.stderr.write('WARNING: image cache: %s\n'%msg)
+
+##########################################################################
+##########################################################################
+
+VERSION=2
+
+DEFAULT_MAX_SIZE_MB=1024
+
+IMAGE_EXT='.img'
+
+STATS_NAME='stats.log'
+
+CacheStats=collections.namedtuple('CacheStats','hits misses num_images size')
+
+class ImageCache:
+    def __init__(self,path,max_size):
+        self._path=path
+        self._max_size=max_size
+        self.hits=0
+        self.misses=0
+
+        os.makedirs(self._path,exist_ok=True)
+
+    def get_key(self,source_paths,files,*options):
+        '''get cache key for image made from FILES, an iterable of
+bbc_inf.BBCFile-style records, and OPTIONS. SOURCE_PATHS is the
+source files whose code affects the image data: the tool itself,
+plus any modules it uses to produce the image.'''
+        hasher=hashlib.sha256()
+        hasher.update(b'%d\0'%VERSION)
+
+        for source_path in source_paths:
+            with open(source_path,'rb') as f: source=f.read()
+            hasher.update(b'%d\0'%len(source))
+            hasher.update(source)
+        hasher.update(repr(options).encode('utf-8'))
+
+        for name,load,exec_,attr,data in files:
+            hasher.update(repr((name,load,exec_,attr,len(data))).encode('utf-8'))
+            hasher.update(data)
+
+        return hasher.hexdigest()
+
+    def _get_image_path(self,key): return os.path.join(self._path,key+IMAGE_EXT)
+
+    def _log(self,c):
+        try:
+            with open(os.path.join(self._path,STATS_NAME),'ab') as f: f.write(c)
+        except OSError as e: warn(str(e))
+
+    def get(self,key):
+        '''get image data for KEY, or None if not in cache.'''
+        path=self._get_image_path(key)
+        try:
+            with open(path,'rb') as f: data=f.read()
+            os.utime(path)
+        except OSError: data=None
+
+        if data is None:
+            self.misses+=1
+            self._log(b'M')
+        else:
+            self.hits+=1
+            self._log(b'H')
+
+        return data
+
+    def put(self,key,data):
+        '''store image data for KEY, then trim the cache to size.'''
+        try:
+            # write to a temp file and rename, so concurrent builds
+            # never see a partial image.
+            fd,temp_path=tempfile.mkstemp(dir=self._path,suffix='.tmp')
+            with os.fdopen(fd,'wb') as f: f.write(data)
+            os.replace(temp_path,self._get_image_path(key))
+        except OSError as e: warn(str(e))
+
+        self.trim()
+
+    def _get_images(self):
+        images=[]
+        for entry in os.scandir(self._path):
+            if entry.name.endswith(IMAGE_EXT):
+                try: images.append((entry.stat().st_mtime,entry.stat().st_size,entry.path))
+                except OSError: pass
+        return images
+
+    def trim(self,max_size=None):
+        '''discard least recently used images until the total size is
+no more than MAX_SIZE bytes (or the cache's max size, if None).'''
+        if max_size is None: max_size=self._max_size
+
+        images=self._get_images()
+        size=sum(image[1] for image in images)
+        for mtime,image_size,path in sorted(images):
+            if size<=max_size: break
+            try:
+                os.unlink(path)
+                size-=image_size
+            except OSError as e: warn(str(e))
+
+    def get_stats(self):
+        '''get CacheStats for this cache, accumulated over all runs.'''
+        hits=0
+        misses=0
+        try:
+            with open(os.path.join(self._path,STATS_NAME),'rb') as f: log=f.read()
+            hits=log.count(b'H')
+            misses=log.count(b'M')
+        except FileNotFoundError: pass
+
+        images=self._get_images()
+        return CacheStats(hits=hits,
+                          misses=misses,
+                          num_images=len(images),
+                          size=sum(image[1] for image in images))
+
+    def reset_stats(self):
+        try: os.unlink(os.path.join(self._path,STATS_NAME))
+        except FileNotFoundError: pass
+
+##########################################################################
+##########################################################################
+
+def add_arguments(parser):
+    '''add image cache options to argparse parser PARSER.'''
+    parser.add_argument('--cache-dir',metavar='DIR',default=None,help='''reuse previously built images from cache in %(metavar)s, if the inputs and options haven't changed''')
+    parser.add_argument('--cache-size',metavar='MB',type=int,default=DEFAULT_MAX_SIZE_MB,help='''limit image cache to %(metavar)s MB. Default: %(default)s''')
+
+def create_cache(options):
+    '''create ImageCache as specified by options added by
+add_arguments, or None if no cache.'''
+    if options.cache_dir is None: return None
+    return ImageCache(options.cache_dir,options.cache_size*1024*1024)
+
+##########################################################################
+##########################################################################
+
+def print_stats(cache):
+    stats=cache.get_stats()
+    total=stats.hits+stats.misses
+    print('%d hit(s), %d miss(es)%s'%(stats.hits,
+                                      stats.misses,
+                                      ' (%.1f%% hits)'%(100.0*stats.hits/total) if total>0 else ''))
+    print('%d image(s), %d bytes'%(stats.num_images,stats.size))
+
+def stats_cmd(options):
+    cache=ImageCache(options.cache_dir,0)
+    print_stats(cache)
+    if options.reset: cache.reset_stats()
+
+def trim_cmd(options):
+    ImageCache(options.cache_dir,0).trim(options.size*1024*1024)
+
+def main(argv):
+    parser=argparse.ArgumentParser(description='manage disc image cache')
+    parser.set_defaults(fun=None)
+    subparsers=parser.add_subparsers()
+
+    def add_subparser(fun,name,**kwargs):
+        subparser=subparsers.add_parser(name,**kwargs)
+        subparser.set_defaults(fun=fun)
+        return subparser
+
+    stats_parser=add_subparser(stats_cmd,'stats',help='''print cache hit/miss stats''')
+    stats_parser.add_argument('cache_dir',metavar='DIR',help='''use cache in %(metavar)s''')
+    stats_parser.add_argument('--reset',action='store_true',help='''reset hit/miss counts afterwards''')
+
+    trim_parser=add_subparser(trim_cmd,'trim',help='''discard least recently used images''')
+    trim_parser.add_argument('cache_dir',metavar='DIR',help='''use cache in %(metavar)s''')
+    trim_parser.add_argument('size',metavar='MB',type=int,help='''discard images until cache is at most %(metavar)s MB''')
+
+    options=parser.parse_args(argv)
+    if options.fun is None:
+        parser.print_help()
+        sys.exit(1)
+
+    options.fun(options)
+
+##########################################################################
+##########################################################################
+
+if __name__=='__main__': main(sys.argv[1:])
@@ -0,0 +1,141 @@
+import sys,os,os.path,json,tempfile,collections,concurrent.futures
+
+##########################################################################
+##########################################################################
+
+# Shared .inf scanner for ssd_create and adf_create.
+#
+# Each folder is listed once with os.scandir, rather than checking
+# for each file's .inf individually, and the .inf files are then
+# stat'd and read on a thread pool, as most of the time goes on
+# waiting for the file system - particularly on network drives.
+#
+# Parsed .inf contents can be cached in a JSON file, keyed by path,
+# size and mtime, so unchanged .inf files aren't read again.
+
+##########################################################################
+##########################################################################
+
+def warn(msg): sys.stderr.write('WARNING: .inf cache: %s\n'%msg)
+
+##########################################################################
+##########################################################################
+
+VERSION=1
+
+class InfCache:
+    def __init__(self,path):
+        self._path=path
+        self._entries={}
+        self._dirty=False
+
+        try:
+            with open(self._path,'rt') as f: data=json.load(f)
+            if data.get('version')==VERSION: self._entries=data['entries']
+        except FileNotFoundError: pass
+        except (OSError,ValueError,KeyError,AttributeError) as e: warn(str(e))
+
+    def get(self,inf_path,st):
+        '''get cached fields for INF_PATH, with os.stat result ST, or
+None if not cached or out of date.'''
+        entry=self._entries.get(os.path.abspath(inf_path))
+        if entry is None: return None
+        if entry[0]!=st.st_mtime_ns or entry[1]!=st.st_size: return None
+        return entry[2]
+
+    def put(self,inf_path,st,fields):
+        self._entries[os.path.abspath(inf_path)]=[st.st_mtime_ns,
+                                                  st.st_size,
+                                                  fields]
+        self._dirty=True
+
+    def save(self):
+        if not self._dirty: return
+
+        try:
+            # write to a temp file and rename, so concurrent builds
+            # never see a partial file.
+            fd,temp_path=tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(self._path)),
+                                          suffix='.tmp')
+            with os.fdopen(fd,'wt') as f:
+                json.dump({'version':VERSION,'entries':self._entries},f)
+            os.replace(temp_path,self._path)
+            self._dirty=False
+        except OSError as e: warn(str(e))
+
+##########################################################################
+##########################################################################
+
+# INF_PATH is the path of PATH's .inf file, or None if there isn't
+# one. INF_FIELDS is the whitespace-separated fields from the first
+# line of the .inf file, or None if there isn't one or it's empty.
+ScannedFile=collections.namedtuple('ScannedFile','path inf_path inf_fields')
+
+def _list_dir(path):
+    try:
+        with os.scandir(path or os.curdir) as it:
+            return set(os.path.normcase(entry.name)
+                       for entry in it
+                       if entry.is_file())
+    except OSError: return set()
+
+def _read_inf(inf_path,cache):
+    st=os.stat(inf_path)
+    if cache is not None:
+        fields=cache.get(inf_path,st)
+        if fields is not None: return fields
+
+    with open(inf_path,'rt') as f: line=f.readline()
+
+    fields=line.split()
+    if cache is not None: cache.put(inf_path,st,fields)
+    return fields
+
+def scan_files(paths,num_threads=None,cache=None):
+    '''find and read the .inf files for PC files PATHS, using up to
+NUM_THREADS threads (None for a default based on the CPU count), and
+InfCache CACHE if not None. Returns list of ScannedFile, in PATHS
+order.'''
+    with concurrent.futures.ThreadPoolExecutor(max_workers=num_threads) as pool:
+        folders=sorted(set(os.path.dirname(path) for path in paths))
+        folder_names=dict(zip(folders,pool.map(_list_dir,folders)))
+
+        inf_paths=[]
+        for path in paths:
+            name=os.path.normcase(os.path.basename(path)+'.inf')
+            if name in folder_names[os.path.dirname(path)]:
+                inf_paths.append(path+'.inf')
+            else: inf_paths.append(None)
+
+        inf_fields=iter(pool.map(lambda inf_path:_read_inf(inf_path,cache),
+                                 [inf_path for inf_path in inf_paths if inf_path is not None]))
+
+    if cache is not None: cache.save()
+
+    result=[]
+    for path,inf_path in zip(paths,inf_paths):
+        fields=None
+        if inf_path is not None:
+            fields=next(inf_fields)
+            if len(fields)==0: fields=None
+        result.append(ScannedFile(path,inf_path,fields))
+
+    return result
+
+##########################################################################
+##########################################################################
+
+def add_arguments(parser):
+    '''add .inf scanning options to argparse parser PARSER.'''
+    parser.add_argument('--scan-threads',metavar='N',type=int,default=None,help='''read .inf files using %(metavar)s threads. Default: based on CPU count''')
+    parser.add_argument('--inf-cache',metavar='FILE',default=None,help='''cache .inf file contents in %(metavar)s, so unchanged .inf files aren't read again''')
+
+def create_cache(options):
+    '''create InfCache as specified by options added by add_arguments,
+or None if no cache.'''
+    if options.inf_cache is None: return None
+    return InfCache(options.inf_cache)
+
+def scan_files_for_options(paths,options):
+    '''scan_files, configured by options added by add_arguments.'''
+    return scan_files(paths,options.scan_threads,create_cache(options))
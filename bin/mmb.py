@@ -1,5 +1,5 @@
 #!/usr/bin/python3
-import sys,os,os.path,argparse,collections,glob
+import sys,os,os.path,argparse,collections,glob,mmap,multiprocessing,ssd_extract
 
 ##########################################################################
 ##########################################################################
@@ -48,6 +48,14 @@ def get_disk_type_str(type):
 
 def is_valid_disk_name_char(c): return ord(c)>=32 and ord(c)<127
 
+def get_disk_name_error(name):
+    '''get reason NAME isn't a valid disk name, or None if it is.'''
+    if len(name)>=12: return 'name too long (max 11 chars)'
+    for c in name:
+        if not is_valid_disk_name_char(c):
+            return 'invalid char in name: %r'%c
+    return None
+
 ##########################################################################
 ##########################################################################
 
@@ -61,7 +69,7 @@ class MMB:
         self._data=data
 
         if len(data)!=MMB_SIZE:
-            self._error('wrong size be an MMB file')
+            self._error('wrong size to be an MMB file')
         
         if data[0:16]!=MMB_HEADER:
             self._error('not an MMB file')
@@ -71,7 +79,10 @@ class MMB:
             if not is_valid_disk_type(type):
                 self._error('invalid disk type (0x%02X) for disk %d'%(type,i))
 
-    def make_mutable(self): self._data=bytearray(self._data)
+    def make_mutable(self):
+        # a writeable mmap is already mutable.
+        if not isinstance(self._data,mmap.mmap):
+            self._data=bytearray(self._data)
 
     @property
     def data(self): return self._data
@@ -108,34 +119,90 @@ class MMB:
         return self._data[i:i+n].decode('ascii')
 
     def set_disk_name(self,index,name):
-        assert len(name)<12
-        i=self._get_metadata_offset(index)
+        error=get_disk_name_error(name)
+        if error is not None: raise ValueError(error)
 
+        i=self._get_metadata_offset(index)
         for j in range(12):
-            if j<len(name):
-                assert is_valid_disk_name_char(name[j])
-                self._data[i+j]=ord(name[j])
+            if j<len(name): self._data[i+j]=ord(name[j])
             else: self._data[i+j]=0
 
     def set_disk_contents(self,index,contents):
         assert len(contents)<=SSD_SIZE
         i=self._get_contents_offset(index)
-        for j in range(len(contents)): self._data[i+j]=contents[j]
-        for j in range(len(contents),SSD_SIZE): self._data[i+j]=0
+        n=len(contents)
+        self._data[i:i+n]=contents
+        self._data[i+n:i+SSD_SIZE]=bytes(SSD_SIZE-n)
+
+    def get_disk_contents(self,index):
+        '''get memoryview of disk's slot. Release it before closing the
+MMB.'''
+        i=self._get_contents_offset(index)
+        with memoryview(self._data) as data: return data[i:i+SSD_SIZE]
+
+    def is_disk_contents_equal(self,index,contents):
+        '''true if disk's slot holds CONTENTS followed by zero padding.'''
+        assert len(contents)<=SSD_SIZE
+        i=self._get_contents_offset(index)
+        n=len(contents)
+        with memoryview(self._data) as data:
+            return (data[i:i+n]==contents and
+                    data[i+n:i+SSD_SIZE]==bytes(SSD_SIZE-n))
+
+    def set_disk_contents_from_file(self,index,f):
+        '''read disk contents from binary file F straight into the disk's
+slot, zero-filling the remainder. Returns number of bytes read. Raises
+ValueError, leaving the slot untouched, if F is too large.'''
+        if os.fstat(f.fileno()).st_size>SSD_SIZE:
+            raise ValueError('too large to be a .ssd')
+
+        i=self._get_contents_offset(index)
+        with memoryview(self._data) as data:
+            slot=data[i:i+SSD_SIZE]
+            n=0
+            while n<SSD_SIZE:
+                num_read=f.readinto(slot[n:])
+                if not num_read: break
+                n+=num_read
+
+            slot[n:]=bytes(SSD_SIZE-n)
+            slot.release()
+
+        return n
 
     def save(self):
         assert self._path is not None
-        with open(self._path,'wb') as f: f.write(self._data)
+        if isinstance(self._data,mmap.mmap):
+            # changes have been made in place - just make sure they
+            # get to the disk.
+            self._data.flush()
+        else:
+            with open(self._path,'wb') as f: f.write(self._data)
+
+    def close(self):
+        if isinstance(self._data,mmap.mmap): self._data.close()
 
 ##########################################################################
 ##########################################################################
 
-def load_data(path):
-    try:
-        with open(path,'rb') as f: return f.read()
+def load_mmb_from_file(path,writeable=False):
+    '''load MMB from file, memory mapped. If WRITEABLE, changes to the
+MMB modify the file in place, and only the pages touched get written.'''
+    try: f=open(path,'r+b' if writeable else 'rb')
     except FileNotFoundError: fatal('file not found: %s'%path)
 
-def load_mmb_from_file(path): return MMB(load_data(path),path)
+    with f:
+        if os.fstat(f.fileno()).st_size!=MMB_SIZE:
+            fatal('%s: wrong size to be an MMB file'%path)
+
+        data=mmap.mmap(f.fileno(),
+                       0,
+                       access=mmap.ACCESS_WRITE if writeable else mmap.ACCESS_READ)
+
+    return MMB(data,path)
+
+def get_disk_name_from_path(path):
+    return os.path.splitext(os.path.basename(path))[0]
 
 ##########################################################################
 ##########################################################################
@@ -174,15 +241,12 @@ def create_cmd(options):
 ##########################################################################
 
 def set_cmd(options):
-    mmb=load_mmb_from_file(options.mmb_path)
-    mmb.make_mutable()
-
     if options.name is not None:
-        if len(options.input_paths)>1:
+        if len(options.ssd_paths)>1:
             fatal('''can't set name if multiple disks specified''')
             
-        if len(options.name)>12: fatal('name too long')
-        mmb.set_disk_name(options.index,options.name)
+        error=get_disk_name_error(options.name)
+        if error is not None: fatal(error)
 
     # expand globs
     ssd_paths=[]
@@ -192,23 +256,210 @@ def set_cmd(options):
             if path not in ssd_paths: ssd_paths.append(path)
 
     if len(ssd_paths)==0: fatal('paths did not match any files')
-    
-    index=options.index
+
+    if options.index<0 or options.index+len(ssd_paths)>511:
+        fatal('disk index out of range')
+
+    # the MMB is modified in place, so check everything up front -
+    # including opening each file, and checking the size of what was
+    # opened - before anything is written.
+    ssd_files=[]
     for ssd_path in ssd_paths:
-        ssd=load_data(ssd_path)
-        if len(ssd)>SSD_SIZE: fatal('%s: too large to be a .ssd'%len(ssd))
-        mmb.set_disk_contents(index,ssd)
+        try: f=open(ssd_path,'rb')
+        except OSError as e: fatal('%s: %s'%(ssd_path,e.strerror))
+        ssd_files.append(f)
+
+        if os.fstat(f.fileno()).st_size>SSD_SIZE:
+            fatal('%s: too large to be a .ssd'%ssd_path)
+
+        if options.name is None:
+            error=get_disk_name_error(get_disk_name_from_path(ssd_path))
+            if error is not None: fatal('%s: %s'%(ssd_path,error))
+
+    mmb=load_mmb_from_file(options.mmb_path,writeable=True)
+
+    if options.name is not None: mmb.set_disk_name(options.index,options.name)
+
+    index=options.index
+    for ssd_path,f in zip(ssd_paths,ssd_files):
+        with f: mmb.set_disk_contents_from_file(index,f)
 
         mmb.set_disk_type(index,
                           TYPE_RO if options.read_only else TYPE_RW)
 
         if options.name is None:
-            name=os.path.splitext(os.path.basename(ssd_path))[0]
-            mmb.set_disk_name(index,name)
+            mmb.set_disk_name(index,get_disk_name_from_path(ssd_path))
 
         index+=1
         
     mmb.save()
+    mmb.close()
+
+##########################################################################
+##########################################################################
+
+def load_manifest(path):
+    '''load sync manifest: one INDEX PATH pair per line. Blank lines
+and lines starting with # are ignored.'''
+    entries=[]
+    indexes_seen=set()
+    try:
+        with open(path,'rt') as f: lines=f.readlines()
+    except FileNotFoundError: fatal('file not found: %s'%path)
+
+    for line_idx,line in enumerate(lines):
+        line=line.strip()
+        if len(line)==0 or line.startswith('#'): continue
+
+        parts=line.split(None,1)
+        if len(parts)!=2: fatal('%s:%d: expected INDEX PATH'%(path,line_idx+1))
+
+        try: index=auto_int(parts[0])
+        except ValueError: fatal('%s:%d: bad index: %s'%(path,line_idx+1,parts[0]))
+
+        if index<0 or index>=511:
+            fatal('%s:%d: disk index out of range: %d'%(path,line_idx+1,index))
+
+        if index in indexes_seen:
+            fatal('%s:%d: duplicate disk index: %d'%(path,line_idx+1,index))
+        indexes_seen.add(index)
+
+        # paths are relative to the manifest.
+        ssd_path=os.path.join(os.path.dirname(path),parts[1])
+        entries.append((index,ssd_path))
+
+    return entries
+
+def sync_cmd(options):
+    entries=load_manifest(options.manifest_path)
+
+    # the MMB is modified in place, so check everything up front.
+    for index,ssd_path in entries:
+        if not os.path.isfile(ssd_path): fatal('file not found: %s'%ssd_path)
+        if os.path.getsize(ssd_path)>SSD_SIZE:
+            fatal('%s: too large to be a .ssd'%ssd_path)
+        error=get_disk_name_error(get_disk_name_from_path(ssd_path))
+        if error is not None: fatal('%s: %s'%(ssd_path,error))
+
+    mmb=load_mmb_from_file(options.mmb_path,writeable=not options.dry_run)
+
+    type=TYPE_RO if options.read_only else TYPE_RW
+
+    num_updated=0
+    for index,ssd_path in entries:
+        with open(ssd_path,'rb') as f: contents=f.read()
+        name=get_disk_name_from_path(ssd_path)
+
+        changes=[]
+        if not mmb.is_disk_contents_equal(index,contents):
+            changes.append('contents')
+            if not options.dry_run: mmb.set_disk_contents(index,contents)
+
+        if mmb.get_disk_name(index)!=name:
+            changes.append('name')
+            if not options.dry_run: mmb.set_disk_name(index,name)
+
+        if mmb.get_disk_type(index)!=type:
+            changes.append('type')
+            if not options.dry_run: mmb.set_disk_type(index,type)
+
+        if len(changes)>0:
+            num_updated+=1
+            msg='%03d. %s: %s\n'%(index,name,', '.join(changes))
+            if options.dry_run: sys.stdout.write(msg)
+            else: pv(msg)
+
+    pv('%d/%d disk(s) %s\n'%(num_updated,
+                              len(entries),
+                              'need updating' if options.dry_run else 'updated'))
+
+    if not options.dry_run: mmb.save()
+    mmb.close()
+
+##########################################################################
+##########################################################################
+
+def get_extract_fname(mmb,index):
+    name=ssd_extract.get_pc_name(mmb.get_disk_name(index))
+    if len(name)==0: return '%03d.ssd'%index
+    else: return '%03d.%s.ssd'%(index,name)
+
+def extract_disk(mmb,index,options):
+    '''extract one disk. Returns a ssd_extract.BatchResult.'''
+    fname=get_extract_fname(mmb,index)
+    contents=mmb.get_disk_contents(index)
+    try:
+        if options.beeblink:
+            ssd_options=argparse.Namespace(verbose=False,
+                                           not_emacs=False,
+                                           basic=options.basic,
+                                           dest_dir=options.output_path,
+                                           drive0=None,
+                                           drive2=None,
+                                           _62=False)
+            result=ssd_extract.batch_extract(ssd_options,fname,contents)
+        else:
+            error=None
+            try:
+                with open(os.path.join(options.output_path,fname),'wb') as f:
+                    f.write(contents)
+            except OSError as e: error=str(e)
+            result=ssd_extract.BatchResult(fname=fname,output='',error=error)
+    finally: contents.release()
+
+    return result
+
+g_extract_mmb=None
+
+def _init_extract_worker(mmb_path):
+    global g_extract_mmb
+    g_extract_mmb=load_mmb_from_file(mmb_path)
+
+def _extract_worker(args): return extract_disk(g_extract_mmb,*args)
+
+def extract_cmd(options):
+    mmb=load_mmb_from_file(options.mmb_path)
+
+    if len(options.indexes)==0:
+        indexes=[i for i in range(511) if mmb.get_disk_type(i) in [TYPE_RO,TYPE_RW]]
+    else:
+        indexes=options.indexes
+        for index in indexes:
+            if index<0 or index>=511: fatal('disk index out of range: %d'%index)
+            if mmb.get_disk_type(index) not in [TYPE_RO,TYPE_RW]:
+                fatal('disk %d is not formatted'%index)
+
+    if not os.path.isdir(options.output_path): os.makedirs(options.output_path)
+
+    num_jobs=options.jobs
+    if num_jobs is None: num_jobs=os.cpu_count() or 1
+    num_jobs=max(1,min(num_jobs,len(indexes)))
+
+    failures=[]
+    def handle_result(result):
+        pv('%s\n'%result.fname)
+        if len(result.output)>0: sys.stdout.write(result.output)
+        if result.error is not None:
+            sys.stderr.write('ERROR: %s: %s\n'%(result.fname,result.error))
+            failures.append(result)
+
+    if num_jobs==1:
+        for index in indexes: handle_result(extract_disk(mmb,index,options))
+    else:
+        # each worker maps the MMB itself (an mmap can't be shared
+        # with the pool), but the pages come from the same page
+        # cache, and disks are extracted from slices of the mapping.
+        with multiprocessing.Pool(num_jobs,
+                                  _init_extract_worker,
+                                  (options.mmb_path,)) as pool:
+            for result in pool.imap_unordered(_extract_worker,
+                                              [(index,options) for index in indexes]):
+                handle_result(result)
+
+    mmb.close()
+
+    pv('%d disk(s) extracted\n'%(len(indexes)-len(failures)))
+    if len(failures)>0: fatal('%d disk(s) failed to extract'%len(failures))
 
 ##########################################################################
 ##########################################################################
@@ -242,6 +493,22 @@ def main(argv):
     set_parser.add_argument('index',type=auto_int,metavar='INDEX',help='''set disk(s) starting from index %(metavar)s''')
     set_parser.add_argument('ssd_paths',metavar='SSD',nargs='+',help='''set disk contents from %(metavar)s (wildcards will be expanded)''')
 
+    sync_parser=add_subparser(sync_cmd,'sync',help='''update MMB disks from manifest, rewriting only disks that differ''')
+    sync_parser.add_argument('mmb_path',metavar='MMB',help='''modify MMB file %(metavar)s''')
+    sync_parser.add_argument('manifest_path',metavar='MANIFEST',help='''read disks from %(metavar)s: one line per disk, with disk index and .ssd path (relative to %(metavar)s) separated by whitespace''')
+    sync_parser.add_argument('-r','--read-only',action='store_true',help='''mark disk(s) as read-only''')
+    sync_parser.add_argument('--dry-run',action='store_true',help='''only print disks that would be updated''')
+
+    extract_parser=add_subparser(extract_cmd,'extract',help='''extract disks from MMB''')
+    extract_parser.add_argument('mmb_path',metavar='MMB',help='''read MMB file %(metavar)s''')
+    extract_parser.add_argument('-o','--output-dir',dest='output_path',default='.',metavar='DIR',help='''write disks to %(metavar)s, as NNN.NAME.ssd (or BeebLink folder NNN.NAME). Default: %(default)s''')
+    extract_parser.add_argument('--beeblink',action='store_true',help='''extract each disk to a BeebLink folder, as per ssd_extract, rather than a .ssd''')
+    if ssd_extract.can_convert_basic:
+        extract_parser.add_argument('-b','--basic',action='store_true',help='''with --beeblink, find tokenized BASIC source files and save text copies''')
+    extract_parser.set_defaults(basic=False)
+    extract_parser.add_argument('-j','--jobs',type=int,default=None,metavar='N',help='''use %(metavar)s worker processes. Default: one per CPU''')
+    extract_parser.add_argument('indexes',type=auto_int,nargs='*',metavar='INDEX',help='''extract disk %(metavar)s (default: all formatted disks)''')
+
     options=parser.parse_args(argv)
     if options.fun is None:
         parser.print_help()
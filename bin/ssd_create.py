@@ -1,5 +1,5 @@
 #!/usr/bin/python3
-import argparse,os,os.path,sys,struct,glob,collections
+import argparse,os,os.path,sys,struct,glob,collections,bisect,bbc_inf,image_cache,inf_scan
 
 ##########################################################################
 ##########################################################################
@@ -25,19 +25,6 @@ def v(str):
 ##########################################################################
 ##########################################################################
 
-def get_data(xs):
-    data=bytearray()
-    for x in xs:
-        if isinstance(x,int): data.append(x)
-        elif isinstance(x,str):
-            assert len(x)==1,x
-            data.append(ord(x))
-        else: assert False,(x,type(x))
-    return data
-
-##########################################################################
-##########################################################################
-
 BeebFile=collections.namedtuple('Metadata','pc_path dir name load exec_ locked data')
 
 File=collections.namedtuple('File','pc_path beeb_name')
@@ -81,19 +68,18 @@ def get_beeb_files(files,options):
     beeb_names_seen_lc=set()
     inf_paths_seen=set()
 
+    scanned_files=inf_scan.scan_files_for_options([file.pc_path for file in files],
+                                                  options)
+
     result=[]
-    for file in files:
+    for file,scanned_file in zip(files,scanned_files):
         # don't treat used .inf paths as Beeb files!
         if file.pc_path in inf_paths_seen: continue
-        
-        inf_path='%s.inf'%file.pc_path
 
         inf_data=None
-        if os.path.isfile(inf_path):
-            inf_paths_seen.add(inf_path)
-            with open(inf_path,'rt') as f:
-                inf_lines=f.readlines()
-                if len(inf_lines)>0: inf_data=inf_lines[0].split()
+        if scanned_file.inf_path is not None:
+            inf_paths_seen.add(scanned_file.inf_path)
+            inf_data=scanned_file.inf_fields
 
         if inf_data is None:
             inf_data=[os.path.basename(file.pc_path),
@@ -146,10 +132,7 @@ def get_beeb_files(files,options):
 def get_boot_beeb_file(lines):
     if len(lines)==0: return None
     else:
-        data=b''
-        for line in lines:
-            data+=get_data(list(line))
-            data+=b'\r'
+        data=b''.join(line.encode('latin_1')+b'\r' for line in lines)
 
         return BeebFile(pc_path='<<command line>>',
                         dir='$',
@@ -181,6 +164,213 @@ def get_unique_paths(files):
 
 FileRegion=collections.namedtuple('FileRegion','sector num_sectors')
 
+def get_first_data_sector(watford62):
+    # Watford DFS's second catalogue occupies sectors 2 and 3.
+    return 4 if watford62 else 2
+
+def get_max_num_files(watford62): return 62 if watford62 else 31
+
+def get_num_data_sectors(num_disc_sectors,watford62):
+    return num_disc_sectors-2-get_first_data_sector(watford62)
+
+def get_file_num_sectors(file): return (len(file.data)+255)//256
+
+def build_ssd(files,title,opt4,num_disc_sectors,watford62=False):
+    """build .ssd image in memory from list of BeebFile FILES. Returns
+    the image as a bytearray, trimmed to the sectors actually used.
+    If WATFORD62, use the Watford DFS 62-file catalogue format. Raises
+    ValueError if the files don't fit."""
+    max_num_files=get_max_num_files(watford62)
+    if len(files)>max_num_files:
+        raise ValueError('Too many files - disk has %d files, but max is %d'%(len(files),max_num_files))
+
+    next_sector=get_first_data_sector(watford62)
+    file_regions=[]
+
+    for file in files:
+        region=FileRegion(sector=next_sector,
+                          num_sectors=get_file_num_sectors(file))
+        file_regions.append(region)
+        next_sector+=region.num_sectors
+
+        v("    %s.%-8s %08X %08X %08X %s "%(file.dir,
+                                            file.name,
+                                            file.load,
+                                            file.exec_,
+                                            len(file.data),
+                                            "L" if file.locked else ""))
+
+        v(" @%d"%region.sector)
+
+        v("\n")
+
+    if next_sector>num_disc_sectors-2:
+        raise ValueError("Too much data - disk has %d sectors, but files use %d sectors"%(num_disc_sectors,next_sector))
+
+    image=bytearray(num_disc_sectors*256)
+
+    # Create catalogue(s). Unused name bytes are spaces.
+    image[8:256]=248*b' '
+    if watford62:
+        # Second catalogue marker.
+        image[512:520]=8*b'\xaa'
+        image[520:768]=248*b' '
+
+    # Store title.
+    for i,c in enumerate(title):
+        if i<8: image[i]=ord(c)
+        else: image[256+i-8]=ord(c)
+
+    # Store metadata.
+    #
+    # Files are stored in reverse sector order. With the Watford
+    # catalogue, the first catalogue has the 31 files at the end of
+    # the disc, and the second catalogue the rest.
+    cat_files=[list(reversed(range(len(files))))]
+    if watford62: cat_files=[cat_files[0][:31],cat_files[0][31:]]
+
+    for cat_idx,file_idxs in enumerate(cat_files):
+        cat=cat_idx*512
+        image[cat+256+4]=0                 # Disk write count
+        image[cat+256+5]=len(file_idxs)*8
+        image[cat+256+6]=((opt4<<4)|
+                          ((num_disc_sectors>>8)&3))
+        image[cat+256+7]=num_disc_sectors&255
+
+        # Store catalogue data.
+        for entry_idx,i in enumerate(file_idxs):
+            file=files[i]
+            region=file_regions[i]
+        
+            offset=cat+8+8*entry_idx
+
+            name=file.name.encode('latin_1')
+            image[offset:offset+len(name)]=name
+            image[offset+7]=ord(file.dir)|(0x80 if file.locked else 0)
+
+            offset+=256
+            image[offset+0]=(file.load>>0)&255
+            image[offset+1]=(file.load>>8)&255
+            image[offset+2]=(file.exec_>>0)&255
+            image[offset+3]=(file.exec_>>8)&255
+            image[offset+4]=(len(file.data)>>0)&255
+            image[offset+5]=(len(file.data)>>8)&255
+            image[offset+6]=(((3 if (file.exec_&0xffff0000) else 0)<<6)|
+                             (((len(file.data)>>16)&3)<<4)|
+                             ((3 if (file.load&0xffff0000) else 0)<<2)|
+                             (((region.sector>>8)&3)<<0))
+            image[offset+7]=region.sector&255
+
+    # Store file data. The image is already zero-filled, so the last
+    # sector of each file is padded already.
+    for i,file in enumerate(files):
+        offset=file_regions[i].sector*256
+        image[offset:offset+len(file.data)]=file.data
+
+    # Trim image to the sectors used.
+    del image[next_sector*256:]
+
+    return image
+
+def create_ssd_image(files,title='',opt4=0,num_tracks=80,watford62=False):
+    """create .ssd image from FILES, an iterable of (name,load,exec,
+    attr,data) records (see bbc_inf.BBCFile), in disc order. Returns
+    the image as a bytearray. If WATFORD62, use the Watford DFS
+    62-file catalogue format. Raises ValueError if the input is
+    invalid."""
+    if len(title)>12: raise ValueError("title is too long - max 12 chars")
+    if opt4<0 or opt4>3: raise ValueError("bad *OPT4 value: %s"%opt4)
+
+    beeb_files=[]
+    for name,load,exec_,attr,data in files:
+        if len(name)<3 or name[1]!='.': raise ValueError('Not a DFS-style name: %s'%name)
+        if len(name)>9: raise ValueError('BBC name too long: %s'%name)
+
+        beeb_files.append(BeebFile(pc_path=None,
+                                   dir=name[0],
+                                   name=name[2:],
+                                   load=load,
+                                   exec_=exec_,
+                                   locked=(attr&bbc_inf.LOCKED_ATTR)!=0,
+                                   data=data))
+
+    return build_ssd(beeb_files,title,opt4,num_tracks*10,watford62)
+
+##########################################################################
+##########################################################################
+
+pack_methods=['first-fit','best-fit']
+
+def pack_files(files,num_sectors,max_num_files,method,num_fixed=0):
+    """distribute FILES, a list of (name,load,exec,attr,data) records,
+    over as few discs as possible, each holding at most NUM_SECTORS
+    sectors of data and MAX_NUM_FILES files. METHOD is first-fit or
+    best-fit, both applied largest file first. The first NUM_FIXED
+    files go on the first disc regardless.
+
+    Returns list of discs, each a list of indexes into FILES, in FILES
+    order. Raises ValueError if a file can't be placed."""
+    sizes=[(len(file[4])+255)//256 for file in files]
+    for i,size in enumerate(sizes):
+        if size>num_sectors:
+            raise ValueError('%s: too large - file uses %d sectors, but max is %d'%(files[i][0],size,num_sectors))
+
+    discs=[]
+    free=[]
+
+    # For best-fit: sorted (num free sectors,disc index) for each disc
+    # that has room for more files.
+    open_discs=[]
+
+    def add_disc():
+        discs.append([])
+        free.append(num_sectors)
+        return len(discs)-1
+
+    def add_file(disc_idx,i):
+        discs[disc_idx].append(i)
+        free[disc_idx]-=sizes[i]
+
+    if num_fixed>0:
+        add_disc()
+        for i in range(num_fixed):
+            if sizes[i]>free[0] or len(discs[0])==max_num_files:
+                raise ValueError('%s: no room on first disc'%files[i][0])
+            add_file(0,i)
+        if len(discs[0])<max_num_files: open_discs.append((free[0],0))
+
+    # The sort is stable, so same-sized files stay in order.
+    order=sorted(range(num_fixed,len(files)),key=lambda i:-sizes[i])
+
+    if method=='first-fit':
+        for i in order:
+            disc_idx=None
+            for j in range(len(discs)):
+                if free[j]>=sizes[i] and len(discs[j])<max_num_files:
+                    disc_idx=j
+                    break
+
+            if disc_idx is None: disc_idx=add_disc()
+            add_file(disc_idx,i)
+    elif method=='best-fit':
+        for i in order:
+            # Find the fullest disc the file fits on.
+            k=bisect.bisect_left(open_discs,(sizes[i],-1))
+            if k<len(open_discs): disc_idx=open_discs.pop(k)[1]
+            else: disc_idx=add_disc()
+
+            add_file(disc_idx,i)
+            if len(discs[disc_idx])<max_num_files:
+                bisect.insort(open_discs,(free[disc_idx],disc_idx))
+    else: raise ValueError('unknown packing method: %s'%method)
+
+    for disc in discs: disc.sort()
+
+    return discs
+
+##########################################################################
+##########################################################################
+
 def ssd_create(options):
     global g_verbose
     g_verbose=options.verbose
@@ -216,97 +406,69 @@ def ssd_create(options):
         opt4=3
 
     # How many usable sectors on this disc?
-    num_disc_sectors=(40 if options._40 else 80)*10
-    v("%d sector(s) on disc\n"%num_disc_sectors)
+    num_tracks=40 if options._40 else 80
+    v("%d sector(s) on disc\n"%(num_tracks*10))
 
     # Add a manually-specified !BOOT, if necessary.
     boot_file=get_boot_beeb_file(options.build)
     if boot_file is not None: files=[boot_file]+files
 
-    if len(files)>31:
-        fatal('Too many files - disk has %d files, but max is 31'%len(files))
-
-    next_sector=2
-    file_regions=[]
-
-    for file in files:
-        region=FileRegion(sector=next_sector,
-                          num_sectors=(len(file.data)+255)//256)
-        file_regions.append(region)
-        next_sector+=region.num_sectors
-
-        v("    %s.%-8s %08X %08X %08X %s "%(file.dir,
-                                            file.name,
-                                            file.load,
-                                            file.exec_,
-                                            len(file.data),
-                                            "L" if file.locked else ""))
+    records=[bbc_inf.BBCFile(name='%s.%s'%(file.dir,file.name),
+                             load=file.load,
+                             exec_=file.exec_,
+                             attr=bbc_inf.LOCKED_ATTR if file.locked else 0,
+                             data=file.data)
+             for file in files]
 
-        v(" @%d"%region.sector)
-
-        v("\n")
-
-    if next_sector>num_disc_sectors-2:
-        fatal("Too much data - disk has %d sectors, but files use %d sectors"%(num_disc_sectors,next_sector))
-
-    # Create catalogue.
-    sectors=[[0]*8+[" "]*248,
-             [0]*256]
-
-    # Store title.
-    for i in range(len(title)):
-        if i<8: sectors[0][i]=title[i]
-        else: sectors[1][i-8]=title[i]
-
-    # Store metadata.
-    sectors[1][4]=0                 # Disk write count
-    sectors[1][5]=len(files)*8
-    sectors[1][6]=((opt4<<4)|
-                   ((num_disc_sectors>>8)&3))
-    sectors[1][7]=num_disc_sectors&255
-
-    # Store catalogue data.
-    next_sector=2
-    for i,file in enumerate(files):
-        region=file_regions[i]
-        
-        # Files are stored in reverse sector order.
-        offset=8+8*(len(files)-1-i)
-
-        for j in range(len(file.name)): sectors[0][offset+j]=file.name[j]
-        sectors[0][offset+7]=ord(file.dir)
-        if file.locked: sectors[0][offset+7]|=0x80
-
-        sectors[1][offset+0]=(file.load>>0)&255
-        sectors[1][offset+1]=(file.load>>8)&255
-        sectors[1][offset+2]=(file.exec_>>0)&255
-        sectors[1][offset+3]=(file.exec_>>8)&255
-        sectors[1][offset+4]=(len(file.data)>>0)&255
-        sectors[1][offset+5]=(len(file.data)>>8)&255
-        sectors[1][offset+6]=(((3 if (file.exec_&0xffff0000) else 0)<<6)|
-                              (((len(file.data)>>16)&3)<<4)|
-                              ((3 if (file.load&0xffff0000) else 0)<<2)|
-                              (((region.sector>>8)&3)<<0))
-        sectors[1][offset+7]=region.sector&255
-
-    # Store file data
-    for i,file in enumerate(files):
-        region=file_regions[i]
-        
-        assert len(sectors)==region.sector
-        for i in range(region.num_sectors):
-            sector=file.data[i*256:i*256+256]
-            sectors.append(sector)
-
-        # The last sector might need padding.
-        sectors[-1]+=(256-len(sectors[-1]))*b'\x00'
-
-    v("%d sectors on disc\n"%len(sectors))
-    v("%d bytes in disc image\n"%(len(sectors)*256))
-
-    if options.output_fname is not None:
-        with open(options.output_fname,"wb") as f:
-            for sector in sectors: f.write(get_data(sector))
+    if options.pack is None: discs=[records]
+    else:
+        if (options.output_fname is not None and
+            '%' not in options.output_fname):
+            fatal("with --pack, output file name must include a %d-style format for the disc number")
+
+        num_sectors=get_num_data_sectors(num_tracks*10,options._62)
+        if options.sector_budget is not None:
+            if options.sector_budget<1 or options.sector_budget>num_sectors:
+                fatal("bad sector budget: %d (max is %d)"%(options.sector_budget,num_sectors))
+            num_sectors=options.sector_budget
+
+        try:
+            discs=[[records[i] for i in file_idxs]
+                   for file_idxs in pack_files(records,
+                                               num_sectors,
+                                               get_max_num_files(options._62),
+                                               options.pack,
+                                               num_fixed=0 if boot_file is None else 1)]
+        except ValueError as e: fatal(str(e))
+
+        total_num_wasted=0
+        for disc_idx,disc in enumerate(discs):
+            num_used=sum(get_file_num_sectors(file) for file in disc)
+            total_num_wasted+=num_sectors-num_used
+            print("disc %d: %d file(s), %d/%d sector(s) used, %d wasted"%(disc_idx,len(disc),num_used,num_sectors,num_sectors-num_used))
+        print("%d disc(s), %d sector(s) wasted"%(len(discs),total_num_wasted))
+
+    cache=image_cache.create_cache(options)
+    for disc_idx,records in enumerate(discs):
+        image=None
+        if cache is not None:
+            key=cache.get_key([__file__,bbc_inf.__file__],records,title,opt4,num_tracks,options._62)
+            image=cache.get(key)
+            if image is not None: v("using cached image\n")
+
+        if image is None:
+            try: image=create_ssd_image(records,title,opt4,num_tracks,options._62)
+            except ValueError as e: fatal(str(e))
+            if cache is not None: cache.put(key,image)
+
+        v("%d sectors on disc\n"%(len(image)//256))
+        v("%d bytes in disc image\n"%len(image))
+
+        if options.output_fname is not None:
+            if options.pack is None: output_fname=options.output_fname
+            else: output_fname=options.output_fname%disc_idx
+
+            with open(output_fname,"wb") as f: f.write(image)
         
 ##########################################################################
 ##########################################################################
@@ -376,6 +538,25 @@ def main(args):
                         action='store_true',
                         help='''be more strict about file naming''')
 
+    parser.add_argument('--62',
+                        dest='_62',
+                        action='store_true',
+                        help='''create a Watford DFS 62-file disk (max 31 files otherwise)''')
+
+    parser.add_argument('--pack',
+                        choices=pack_methods,
+                        default=None,
+                        help='''spread files over as many disks as necessary, using the given method (largest files first), and print a report of wasted sectors. -o FILE must include a %%d-style format for the disk number''')
+
+    parser.add_argument('--sector-budget',
+                        metavar='N',
+                        type=int,
+                        default=None,
+                        help='''with --pack, use at most %(metavar)s data sectors per disk. Default: all of them''')
+
+    image_cache.add_arguments(parser)
+    inf_scan.add_arguments(parser)
+
     parser.add_argument("fnames",
                         nargs="*",
                         metavar="FILE",
@@ -1,5 +1,5 @@
 #!/usr/bin/python3
-import sys,argparse,struct,textwrap,os,os.path
+import sys,argparse,struct,textwrap,os,os.path,io,contextlib,multiprocessing,collections,tarfile,zipfile,mmap
 
 ##########################################################################
 ##########################################################################
@@ -8,6 +8,11 @@ can_convert_basic=False
 try:
     import BBCBasicToText
     can_convert_basic=True
+
+    # Settings for the BASIC listings: BASIC II, and @ labels rather
+    # than line numbers, as the listing supplies its own.
+    basic_decoder=BBCBasicToText.Decoder(dialect='basic2',
+                                         line_numbers=False)
 except ImportError: pass
 
 ##########################################################################
@@ -48,6 +53,10 @@ def get_pc_name(bbc_name):
 ##########################################################################
 ##########################################################################
 
+# DFS catalogue entry. SIDE is the disc side (0 or 1); DIR and NAME
+# the directory char and name; START the first logical sector.
+DFSEntry=collections.namedtuple('DFSEntry','side dir name locked load exec_ length start')
+
 class Disc:
     def __init__(self,
                  num_sides,
@@ -58,6 +67,25 @@ class Disc:
         self.num_tracks=num_tracks
         self.num_sectors=num_sectors
         self.data=data
+        self._view=memoryview(data)
+
+        # (side,DIR,NAME) -> DFSEntry, built on first use.
+        self._index=None
+
+    def close(self):
+        """release the image data, closing it if it's an mmap. Any
+        DiscFiles must be closed first."""
+        self._view.release()
+        if isinstance(self.data,mmap.mmap): self.data.close()
+
+    def __enter__(self): return self
+
+    def __exit__(self,exc_type,exc_value,traceback): self.close()
+
+    def has_sector(self,side,track,sector):
+        """true if the image is large enough to hold the given
+        sector."""
+        return self.get_index(side,track,sector,0)+256<=len(self._view)
 
     def read(self,
              side,
@@ -73,9 +101,8 @@ class Disc:
                    offset,
                    count):
         assert offset+count<=256
-        data=bytearray(count)
-        for i in range(count): data[i]=self.read(side,track,sector,offset+i)
-        return data
+        index=self.get_index(side,track,sector,offset)
+        return bytearray(self._view[index:index+count])
 
     def read_string(self,
                     side,
@@ -83,7 +110,163 @@ class Disc:
                     sector,
                     offset,
                     count):
-        return "".join([chr(x) for x in [self.read(side,track,sector,offset+i) for i in range(count)]])
+        return self.read_bytes(side,track,sector,offset,count).decode('latin_1')
+
+    def get_sector_views(self,
+                         side,
+                         sector,
+                         num_sectors):
+        """get list of memoryviews covering NUM_SECTORS logical sectors
+        on SIDE, starting from logical sector SECTOR.
+
+        Runs of sectors that are adjacent in the image (i.e., all of
+        them, for a single-sided disc) are returned as a single
+        view. Views are clipped to the end of the image data."""
+        views=[]
+        begin=None
+        end=None
+        while num_sectors>0:
+            track=sector//self.num_sectors
+            track_sector=sector%self.num_sectors
+            n=min(num_sectors,self.num_sectors-track_sector)
+
+            index=self.get_index(side,track,track_sector,0)
+            if index==end: end+=n*256
+            else:
+                if begin is not None: views.append(self._view[begin:end])
+                begin=index
+                end=index+n*256
+
+            sector+=n
+            num_sectors-=n
+
+        if begin is not None: views.append(self._view[begin:end])
+        
+        return views
+
+    def get_file_views(self,
+                       side,
+                       sector,
+                       length):
+        """get list of memoryviews covering the contents of LENGTH-byte
+        file starting at logical sector SECTOR on SIDE."""
+        if sector+(length+255)//256>self.num_tracks*self.num_sectors:
+            raise IndexError('file at sector %d runs past end of disc'%sector)
+
+        views=[]
+        for view in self.get_sector_views(side,sector,(length+255)//256):
+            view=view[:length]
+            views.append(view)
+            length-=len(view)
+
+        if length>0:
+            # don't leave the image data exported.
+            for view in views: view.release()
+            raise IndexError('file at sector %d runs past end of disc image'%sector)
+
+        return views
+
+    def get_catalogue(self,side):
+        """get list of DFSEntry for the files on SIDE, in catalogue
+        order, including those in the Watford DFS second catalogue if
+        present. Raises ValueError if the image is too small to hold
+        the catalogue."""
+        if not self.has_sector(side,0,1):
+            raise ValueError('bad image: too small for catalogue')
+        
+        num_files=self.read(side,0,1,5)>>3
+
+        # Catalogue part 2 is Watford only.
+        num_files_2=0
+        if (self.has_sector(side,0,3) and
+            self.read_bytes(side,0,2,0,8)==8*b'\xaa' and
+            self.read_bytes(side,0,3,0,4)==4*b'\x00'):
+            num_files_2=self.read(side,0,3,5)>>3
+
+        entries=[]
+        for file_idx in range(num_files+num_files_2):
+            if file_idx<num_files:
+                cat=0
+                offset=8+file_idx*8
+            else:
+                cat=2
+                offset=8+(file_idx-num_files)*8
+            
+            name=self.read_string(side,0,cat+0,offset,7).rstrip()
+            dir=self.read(side,0,cat+0,offset+7)
+
+            locked=(dir&0x80)!=0
+            dir=chr(dir&0x7F)
+
+            load=(self.read(side,0,cat+1,offset+0)<<0)|(self.read(side,0,cat+1,offset+1)<<8)
+            exec_=(self.read(side,0,cat+1,offset+2)<<0)|(self.read(side,0,cat+1,offset+3)<<8)
+            length=(self.read(side,0,cat+1,offset+4)<<0)|(self.read(side,0,cat+1,offset+5)<<8)
+            start=self.read(side,0,cat+1,offset+7)
+
+            topbits=self.read(side,0,cat+1,offset+6)
+
+            if (topbits>>6)&3:
+                # but there are two bits, so what are you supposed to do?
+                exec_|=0xFFFF0000
+
+            length|=((topbits>>4)&3)<<16
+
+            if (topbits>>2)&3:
+                # but there are two bits, so what are you supposed to do?
+                load|=0xFFFF0000
+
+            start|=((topbits>>0)&3)<<8
+
+            entries.append(DFSEntry(side=side,
+                                    dir=dir,
+                                    name=name,
+                                    locked=locked,
+                                    load=load,
+                                    exec_=exec_,
+                                    length=length,
+                                    start=start))
+
+        return entries
+
+    def get_entry(self,name):
+        """get DFSEntry for BBC file NAME - e.g., ELITE (in $), $.ELITE,
+        or :2.$.ELITE (side 2 of a double-sided disc). Names are
+        case-insensitive. Returns None if not found."""
+        if self._index is None:
+            index={}
+            for side in range(self.num_sides):
+                for entry in self.get_catalogue(side):
+                    index.setdefault((side,
+                                      entry.dir.upper(),
+                                      entry.name.upper()),entry)
+            self._index=index
+
+        side=0
+        if len(name)>=3 and name[0]==':' and name[2]=='.':
+            if name[1]=='0': side=0
+            elif name[1]=='2': side=1
+            else: return None
+            name=name[3:]
+
+        if len(name)>=2 and name[1]=='.':
+            dir=name[0]
+            name=name[2:]
+        else: dir='$'
+
+        return self._index.get((side,dir.upper(),name.upper()))
+
+    def open(self,name):
+        """open BBC file NAME (see get_entry) for reading. Returns a
+        DiscFile. Raises FileNotFoundError if there's no such file, or
+        ValueError if the image is bad (too small for the catalogue, or
+        the file runs past the end of the image)."""
+        entry=self.get_entry(name)
+        if entry is None: raise FileNotFoundError('file not found: %s'%name)
+
+        try: views=self.get_file_views(entry.side,entry.start,entry.length)
+        except IndexError as e: raise ValueError('bad image: %s'%e)
+
+        return DiscFile(views,entry)
 
     def get_index(self,
                   side,
@@ -101,25 +284,193 @@ class Disc:
 
         return index
 
-##########################################################################
-##########################################################################
-    
-def mkdir(dir_name):
-    "try to create folder, ignoring error"
-    try: os.makedirs(dir_name)
-    except: pass
+class DiscFile(io.RawIOBase):
+    """read-only file object for a file in a Disc. ENTRY is its
+    DFSEntry. Reads copy straight from the disc image, and get_views
+    gives the contents with no copying at all."""
+    def __init__(self,views,entry):
+        super().__init__()
+        self.entry=entry
+        self._views=views
+        self._size=sum(len(view) for view in views)
+        self._pos=0
+
+    def readable(self): return True
+
+    def seekable(self): return True
+
+    def tell(self): return self._pos
+
+    def seek(self,offset,whence=io.SEEK_SET):
+        if self.closed: raise ValueError('I/O operation on closed file')
+        if whence==io.SEEK_SET: pos=offset
+        elif whence==io.SEEK_CUR: pos=self._pos+offset
+        elif whence==io.SEEK_END: pos=self._size+offset
+        else: raise ValueError('invalid whence: %r'%whence)
+        if pos<0: raise ValueError('negative seek position: %d'%pos)
+        self._pos=pos
+        return self._pos
+
+    def readinto(self,b):
+        if self.closed: raise ValueError('I/O operation on closed file')
+        b=memoryview(b).cast('B')
+        num_read=0
+        view_begin=0
+        for view in self._views:
+            view_end=view_begin+len(view)
+            if self._pos<view_end and num_read<len(b):
+                begin=self._pos-view_begin
+                n=min(len(view)-begin,len(b)-num_read)
+                b[num_read:num_read+n]=view[begin:begin+n]
+                num_read+=n
+                self._pos+=n
+            view_begin=view_end
+        return num_read
+
+    def readall(self):
+        data=bytearray(max(0,self._size-self._pos))
+        self.readinto(data)
+        return bytes(data)
+
+    def get_views(self):
+        """get list of memoryviews that together make up the file's
+        contents. They're released when the file is closed."""
+        return list(self._views)
+
+    def close(self):
+        if not self.closed:
+            for view in self._views: view.release()
+        super().close()
+
+def get_disc_num_sides(path):
+    """get number of sides for disc image PATH, going by its extension,
+    or None if not a .ssd or .dsd."""
+    ext=os.path.splitext(path)[1].lower()
+    if ext=='.ssd': return 1
+    elif ext=='.dsd': return 2
+    else: return None
+
+def open_image(path):
+    """open .ssd or .dsd disc image PATH for reading individual files
+    with Disc.open. The image is memory mapped, so only the sectors
+    used get read. Close the Disc when done, or use it in a with
+    statement."""
+    num_sides=get_disc_num_sides(path)
+    if num_sides is None: raise ValueError('unrecognised extension: %s'%path)
+
+    with open(path,'rb') as f:
+        if os.fstat(f.fileno()).st_size==0: data=b''
+        else: data=mmap.mmap(f.fileno(),0,access=mmap.ACCESS_READ)
+
+    return Disc(num_sides,80,10,data)
 
 ##########################################################################
 ##########################################################################
 
-def mkdir_and_open(path,mode):
-    mkdir(os.path.split(path)[0])
-    return open(path,mode)
+# Output sinks. Each sink takes the PC paths that main produces for
+# the extracted files, and does something with the data: write(path,
+# views) stores a file whose contents are the concatenation of a list
+# of bytes-like objects, and write_text(path,text) stores a text file.
+
+class FolderSink:
+    """write files to the PC filing system, creating each folder only
+    once."""
+    def __init__(self): self._folders=set()
+
+    def _mkdir(self,path):
+        folder=os.path.dirname(path)
+        if folder not in self._folders:
+            if len(folder)>0: os.makedirs(folder,exist_ok=True)
+            self._folders.add(folder)
+
+    def write(self,path,views):
+        self._mkdir(path)
+        with open(path,'wb') as f:
+            for view in views: f.write(view)
+
+    def write_text(self,path,text):
+        self._mkdir(path)
+        with open(path,'wt') as f: f.write(text)
+
+    def close(self): pass
+
+class DictSink:
+    """store files in a dict of name to bytes, in the files
+    property. Names are relative to ROOT, with / separators."""
+    def __init__(self,root='.'):
+        self._root=root
+        self.files={}
+
+    def get_name(self,path):
+        return os.path.relpath(path,self._root).replace(os.sep,'/')
+
+    def write(self,path,views): self.files[self.get_name(path)]=b''.join(views)
+
+    def write_text(self,path,text): self.write(path,[text.encode('latin_1')])
+
+    def close(self): pass
+
+class ZipSink(DictSink):
+    """write files to a zip file at ZIP_PATH."""
+    def __init__(self,zip_path,root='.'):
+        DictSink.__init__(self,root)
+        self._zip=zipfile.ZipFile(zip_path,'w',zipfile.ZIP_DEFLATED)
+
+    def write(self,path,views):
+        with self._zip.open(self.get_name(path),'w') as f:
+            for view in views: f.write(view)
+
+    def close(self): self._zip.close()
+
+class TarSink(DictSink):
+    """write files to a tar file at TAR_PATH (compressed according to
+    its extension)."""
+    def __init__(self,tar_path,root='.'):
+        DictSink.__init__(self,root)
+        mode='w'
+        for exts,compression in [(['.gz','.tgz'],'gz'),
+                                 (['.bz2','.tbz2'],'bz2'),
+                                 (['.xz','.txz'],'xz')]:
+            if os.path.splitext(tar_path)[1].lower() in exts:
+                mode='w:'+compression
+        self._tar=tarfile.open(tar_path,mode)
+
+    def write(self,path,views):
+        data=b''.join(views)
+        info=tarfile.TarInfo(self.get_name(path))
+        info.size=len(data)
+        self._tar.addfile(info,io.BytesIO(data))
+
+    def close(self): self._tar.close()
+
+def create_sink(options):
+    """create sink as specified by --tar/--zip options, or a
+    FolderSink."""
+    if options.tar_path is not None: return TarSink(options.tar_path,options.dest_dir)
+    elif options.zip_path is not None: return ZipSink(options.zip_path,options.dest_dir)
+    else: return FolderSink()
 
 ##########################################################################
 ##########################################################################
     
-def main(options):
+def get_dest_dir(options):
+    '''get folder that main writes OPTIONS.fname's files to, or None
+    if nothing is to be written.'''
+    dest_dir=options.dest_dir
+    if dest_dir=='-': return None
+    elif options.drive0 or options.drive2: return dest_dir
+    else:
+        if dest_dir is None:
+            dest_dir=os.path.join(os.path.dirname(options.fname))
+
+        return os.path.join(dest_dir,
+                            os.path.splitext(os.path.basename(options.fname))[0])
+
+def main(options,data=None,sink=None):
+    """convert disc image OPTIONS.fname. If DATA is not None, it's the
+    image contents, and the file isn't read (but its name is still
+    used for determining sidedness and output folder). Files are
+    written to SINK, or a new FolderSink if None."""
     global g_verbose
     g_verbose=options.verbose
 
@@ -134,26 +485,20 @@ def main(options):
         fatal("must specify destination folder explicitly with -0 or -2")
 
     # Figure out disc sidedness.
-    ext=os.path.splitext(options.fname)[1]
-    if ext.lower()=='.ssd':
-        num_sides=1
-        if options.drive2: fatal("disc image is single-sided")
-    elif ext.lower()=='.dsd': num_sides=2
-    else: fatal("unrecognised extension: %s"%ext)
+    num_sides=get_disc_num_sides(options.fname)
+    if num_sides is None:
+        fatal("unrecognised extension: %s"%os.path.splitext(options.fname)[1])
+    elif num_sides==1 and options.drive2: fatal("disc image is single-sided")
 
     # Figure out where to put files.
-    dest_dir=options.dest_dir
-    if dest_dir=='-': dest_dir=None
-    elif options.drive0 or options.drive2: pass
-    else:
-        if dest_dir is None:
-            dest_dir=os.path.join(os.path.dirname(options.fname))
-
-        dest_dir=os.path.join(dest_dir,
-                              os.path.splitext(os.path.basename(options.fname))[0])
+    dest_dir=get_dest_dir(options)
 
     # Load the image
-    with open(options.fname,"rb") as f: image=Disc(num_sides,80,10,f.read())
+    if data is None:
+        with open(options.fname,"rb") as f: data=f.read()
+    image=Disc(num_sides,80,10,data)
+
+    if sink is None: sink=FolderSink()
 
     if options.drive0: sides=[0]
     elif options.drive2: sides=[1]
@@ -162,18 +507,15 @@ def main(options):
     for side in sides:
         drive=side*2
 
+        if not image.has_sector(side,0,1):
+            fatal('disc image too small for side %d catalogue'%drive)
+
         title=(image.read_bytes(side,0,0,0,8)+
                image.read_bytes(side,0,1,0,4)).replace(b'\x00',b'').strip()
 
         num_files=image.read(side,0,1,5)>>3
         option=(image.read(side,0,1,6)>>4)&3
 
-        # Catalogue part 2 is Watford only.
-        num_files_2=0
-        if (image.read_bytes(side,0,2,0,8)==8*b'\xaa' and
-            image.read_bytes(side,0,2,0,4)==4*b'\x00'):
-            num_files_2=image.read(side,0,3,5)>>3
-
         if options.verbose or dest_dir is None:
             print("Side %d: \"%s\": Option %d, %d files"%(side,title,option,num_files))
 
@@ -184,60 +526,30 @@ def main(options):
             else: pc_folder=os.path.join(dest_dir,"%d"%drive)
 
             if len(title)>0:
-                with mkdir_and_open(os.path.join(pc_folder,'.title'),'wb') as f:
-                    f.write(title)
+                sink.write(os.path.join(pc_folder,'.title'),[title])
 
             if option!=0:
-                with mkdir_and_open(os.path.join(pc_folder,'.opt4'),'wt') as f:
-                    print(option,file=f)
+                sink.write_text(os.path.join(pc_folder,'.opt4'),'%d\n'%option)
 
-        for file_idx in range(num_files+num_files_2):
-            if file_idx<num_files:
-                cat=0
-                offset=8+file_idx*8
-            else:
-                cat=2
-                offset=8+(file_idx-num_files)*8
-            
-            name=image.read_string(side,0,cat+0,offset,7).rstrip()
-            dir=image.read(side,0,cat+0,offset+7)
+        for entry in image.get_catalogue(side):
+            dir=entry.dir
+            name=entry.name
+            locked=entry.locked
+            load=entry.load
+            exec_=entry.exec_
+            length=entry.length
+            start=entry.start
 
-            locked=(dir&0x80)!=0
-            dir=chr(dir&0x7F)
-
-            load=(image.read(side,0,cat+1,offset+0)<<0)|(image.read(side,0,cat+1,offset+1)<<8)
-            exec_=(image.read(side,0,cat+1,offset+2)<<0)|(image.read(side,0,cat+1,offset+3)<<8)
-            length=(image.read(side,0,cat+1,offset+4)<<0)|(image.read(side,0,cat+1,offset+5)<<8)
-            start=image.read(side,0,cat+1,offset+7)
-
-            topbits=image.read(side,0,cat+1,offset+6)
-
-            if (topbits>>6)&3:
-                # but there are two bits, so what are you supposed to do?
-                exec_|=0xFFFF0000
-
-            length|=((topbits>>4)&3)<<16
-
-            if (topbits>>2)&3:
-                # but there are two bits, so what are you supposed to do?
-                load|=0xFFFF0000
-
-            start|=((topbits>>0)&3)<<8
-
-            # Grab contents of this file
-            contents=bytearray(length)
-            for i in range(length):
-                byte_sector=start+i//256
-                byte_offset=i%256
-                
-                contents[i]=image.read(side,
-                                       byte_sector//10,
-                                       byte_sector%10,
-                                       byte_offset)
+            # Find contents of this file. Only gather it into one
+            # buffer if it needs examining.
+            views=image.get_file_views(side,start,length)
 
             # Does it look like it could be a BASIC program?
             basic=False
             if options.basic or options.verbose or dest_dir is None:
+                if len(views)==1: contents=views[0]
+                else: contents=b''.join(views)
+
                 i=0
                 while True:
                     if i>=len(contents):
@@ -279,14 +591,14 @@ def main(options):
             if pc_folder is not None:
                 pc_path=os.path.join(pc_folder,pc_name)
 
-                with mkdir_and_open(pc_path+'.inf','wt') as f:
-                    f.write('%s.%s %08x %08x %s'%(dir,
-                                                  name,
-                                                  load,
-                                                  exec_,
-                                                  locked_str))
+                sink.write_text(pc_path+'.inf',
+                                '%s.%s %08x %08x %s'%(dir,
+                                                      name,
+                                                      load,
+                                                      exec_,
+                                                      locked_str))
 
-                with mkdir_and_open(pc_path,"wb") as f: f.write(contents)
+                sink.write(pc_path,views)
 
                 # Write PC copy.
                 if basic:
@@ -294,29 +606,163 @@ def main(options):
                                           'basic/%d'%drive,
                                           pc_name)
                     
-                    class Options: pass
-                    bbtt_options=Options()
-                    bbtt_options.perfect=False
-                    bbtt_options.line_numbers=False
-                    bbtt_options.basicv=False
-                    bbtt_options.basic4=False
-                    bbtt_options.basic2=True
-                    bbtt_options.remove_leading_spaces=False
-                    bbtt_options.codes=False
-                    program=BBCBasicToText.DecodeProgram(contents,bbtt_options)
+                    program=basic_decoder.decode_program(contents)
                     for wrap in [False]:
                         ext=".wrap.txt" if wrap else ".txt"
-                        with mkdir_and_open(raw_path+ext,'wt') as f:
-                            # Produce output like the BASIC Editor (readability
-                            # not guaranteed)
-                            for num,text in program.lines:
-                                wrap_width=64 if wrap else 65536
-                                wrapped=textwrap.wrap(text,wrap_width)
-                                num_text="%5d "%num
-                                for i in range(len(wrapped)):
-                                    if i==0: prefix=num_text
-                                    else: prefix=" "*len(num_text)
-                                    f.write("%s%s\n"%(prefix,wrapped[i]))
+                        # Produce output like the BASIC Editor (readability
+                        # not guaranteed)
+                        text_lines=[]
+                        for num,text in program.lines:
+                            wrap_width=64 if wrap else 65536
+                            wrapped=textwrap.wrap(text,wrap_width)
+                            num_text="%5d "%num
+                            for i in range(len(wrapped)):
+                                if i==0: prefix=num_text
+                                else: prefix=" "*len(num_text)
+                                text_lines.append("%s%s\n"%(prefix,wrapped[i]))
+                        sink.write_text(raw_path+ext,''.join(text_lines))
+
+##########################################################################
+##########################################################################
+
+disc_exts=['.ssd','.dsd']
+
+def find_disc_paths(options):
+    """get list of disc images to convert: FILE args (folders being
+    searched for disc images), plus any from --files-from. Each entry
+    is (path,folder), FOLDER being the image's folder relative to the
+    folder searched, or '' if it wasn't found by searching."""
+    paths=[]
+
+    def add(path):
+        if os.path.isdir(path):
+            for dirpath,dirnames,filenames in os.walk(path):
+                dirnames.sort()
+                folder=os.path.relpath(dirpath,path)
+                if folder==os.curdir: folder=''
+                for filename in sorted(filenames):
+                    if os.path.splitext(filename)[1].lower() in disc_exts:
+                        paths.append((os.path.join(dirpath,filename),folder))
+        else: paths.append((path,''))
+
+    for fname in options.fnames: add(fname)
+
+    if options.files_from is not None:
+        if options.files_from=='-': f=sys.stdin
+        else: f=open(options.files_from,'rt')
+
+        for line in f:
+            line=line.strip()
+            if len(line)>0: add(line)
+
+        if f is not sys.stdin: f.close()
+
+    return paths
+
+##########################################################################
+##########################################################################
+
+BatchResult=collections.namedtuple('BatchResult','fname output error')
+
+def batch_extract(options,fname,data=None,sink=None):
+    """run main for disc image FNAME (contents DATA, if not None),
+    writing to SINK and capturing output. Result is a BatchResult,
+    with error set (to the FATAL message, or exception text) if
+    conversion failed."""
+    options=argparse.Namespace(**vars(options))
+    options.fname=fname
+
+    output=io.StringIO()
+    errors=io.StringIO()
+    error=None
+    try:
+        with contextlib.redirect_stdout(output),contextlib.redirect_stderr(errors):
+            main(options,data,sink)
+    except SystemExit as e:
+        if e.code not in [None,0]: error=errors.getvalue().strip() or 'exit code %s'%e.code
+    except Exception as e: error='%s: %s'%(type(e).__name__,e)
+
+    return BatchResult(fname=fname,output=output.getvalue(),error=error)
+
+def _batch_extract_worker(args): return batch_extract(*args)
+
+def batch_main(options):
+    if options.drive0 or options.drive2:
+        fatal("-0 and -2 can only be used with a single disc image")
+
+    discs=find_disc_paths(options)
+    if len(discs)==0: fatal("no disc images found")
+    fnames=[fname for fname,folder in discs]
+
+    num_jobs=options.jobs
+    if num_jobs is None: num_jobs=os.cpu_count() or 1
+    num_jobs=max(1,min(num_jobs,len(fnames)))
+
+    # there's only one archive, so everything has to go through this
+    # process.
+    sink=create_sink(options)
+    if not isinstance(sink,FolderSink): num_jobs=1
+
+    v("%d disc image(s), %d job(s)\n"%(len(fnames),num_jobs))
+
+    # Images found by searching a folder are output to the
+    # corresponding subfolder of the output folder, so same-named
+    # images in different folders don't clash. Any that would still
+    # share an output folder fail, rather than overwriting each
+    # other's files.
+    jobs=[]
+    fnames_by_dest_dir=collections.defaultdict(list)
+    for fname,folder in discs:
+        job_options=argparse.Namespace(**vars(options))
+        if job_options.dest_dir not in [None,'-']:
+            job_options.dest_dir=os.path.join(job_options.dest_dir,folder)
+
+        job_options.fname=fname
+        dest_dir=get_dest_dir(job_options)
+        if dest_dir is not None:
+            key=os.path.normcase(os.path.abspath(dest_dir))
+            fnames_by_dest_dir[key].append(fname)
+        else: key=None
+
+        jobs.append((job_options,fname,key))
+
+    failures=[]
+    def handle_result(result):
+        if len(result.output)>0:
+            print("%s:"%result.fname)
+            sys.stdout.write(result.output)
+            sys.stdout.flush()
+
+        if result.error is not None:
+            sys.stderr.write("ERROR: %s: %s\n"%(result.fname,result.error))
+            failures.append(result)
+
+    unclashing_jobs=[]
+    for job_options,fname,key in jobs:
+        if key is not None and len(fnames_by_dest_dir[key])>1:
+            others=[other for other in fnames_by_dest_dir[key] if other!=fname]
+            handle_result(BatchResult(fname=fname,
+                                      output='',
+                                      error='output folder clashes with: %s'%', '.join(others)))
+        else: unclashing_jobs.append((job_options,fname))
+    jobs=unclashing_jobs
+
+    if num_jobs==1:
+        for job in jobs: handle_result(batch_extract(*job,sink=sink))
+    else:
+        with multiprocessing.Pool(num_jobs) as pool:
+            for result in pool.imap_unordered(_batch_extract_worker,
+                                              jobs,
+                                              chunksize=max(1,min(64,len(jobs)//(num_jobs*4)))):
+                handle_result(result)
+
+    sink.close()
+
+    if len(failures)>0:
+        sys.stderr.write("%d/%d disc image(s) failed:\n"%(len(failures),len(fnames)))
+        for fname in sorted(failure.fname for failure in failures):
+            sys.stderr.write("    %s\n"%fname)
+        sys.exit(1)
 
 ##########################################################################
 ##########################################################################
@@ -363,16 +809,53 @@ if __name__=="__main__":
                         action='store_true',
                         help='''handle Watford DFS 62-file disks''')
     
-    parser.add_argument("fname",
+    parser.add_argument("--tar",
+                        dest="tar_path",
+                        default=None,
+                        metavar="FILE",
+                        help="write files to tar file %(metavar)s (.gz/.bz2/.xz for compression), named relative to the output dir, rather than to the output dir itself")
+
+    parser.add_argument("--zip",
+                        dest="zip_path",
+                        default=None,
+                        metavar="FILE",
+                        help="write files to zip file %(metavar)s, named relative to the output dir, rather than to the output dir itself")
+
+    parser.add_argument("-j",
+                        "--jobs",
+                        type=int,
+                        default=None,
+                        metavar="N",
+                        help="when converting multiple discs, use %(metavar)s worker processes. Default: one per CPU")
+
+    parser.add_argument("--files-from",
+                        default=None,
+                        metavar="PATH",
+                        help="also convert discs listed in %(metavar)s, one per line (- to read from stdin)")
+
+    parser.add_argument("fnames",
+                        nargs="*",
                         metavar="FILE",
-                        help="name of disc to convert")
+                        help="name of disc(s) to convert. Folders will be searched for .ssd/.dsd files")
 
     args=sys.argv[1:]
 
     options=parser.parse_args(args)
 
     if not can_convert_basic: options.basic=False
-    
-    main(options)
+
+    if options.tar_path is not None and options.zip_path is not None:
+        parser.error("--tar and --zip are mutually exclusive")
+
+    if (len(options.fnames)==1 and
+        options.files_from is None and
+        not os.path.isdir(options.fnames[0])):
+        options.fname=options.fnames[0]
+        sink=create_sink(options)
+        main(options,sink=sink)
+        sink.close()
+    elif len(options.fnames)==0 and options.files_from is None:
+        parser.error("no disc images specified")
+    else: batch_main(options)
     
 #auto_convert("Z:\\beeb\\beebcode\\A5022201.DSD",True)
@@ -1,5 +1,5 @@
 #!/usr/bin/python3
-import sys,os,os.path,argparse,json,hashlib,collections,subprocess
+import sys,os,os.path,argparse,json,hashlib,collections,subprocess,multiprocessing,shutil
 
 sys.path.append(os.path.join(sys.path[0],'../../bin/'))
 import BBCBasicToText
@@ -61,6 +61,89 @@ exclusions=set([
     # 'f8d3b1341bd8d67ff4c9f9875e076c9f040a47d62d5ae9cff67e073b6ddf72e1',
 ])
 
+##########################################################################
+##########################################################################
+
+# Results of previous checks are cached, keyed by file hash, tool
+# version and BASIC version, so each run only checks new files - or
+# everything, if BBCBasicToText or basictool has changed.
+
+CACHE_VERSION=2
+
+def get_tool_version(options):
+    hasher=hashlib.sha256()
+    with open(BBCBasicToText.__file__,'rb') as f: hasher.update(f.read())
+    
+    basictool_path=shutil.which(options.basictool)
+    if basictool_path is not None:
+        with open(basictool_path,'rb') as f: hasher.update(f.read())
+        
+    return hasher.hexdigest()
+
+class ResultsCache:
+    def __init__(self,path,tool_version):
+        self._path=path
+        self._tool_version=tool_version
+        self._results={}
+
+        try:
+            with open(self._path,'rt') as f: j=json.load(f)
+            if j.get('version')==CACHE_VERSION:
+                # results for other tool versions will never be used.
+                prefix='%s:'%self._tool_version
+                self._results={k:v for k,v in j['results'].items() if k.startswith(prefix)}
+        except FileNotFoundError: pass
+
+    def _get_key(self,hash,ver): return '%s:%s:%s'%(self._tool_version,hash,ver)
+
+    def get(self,hash,ver):
+        '''get cached [basictool_ok,match] result, or None.'''
+        return self._results.get(self._get_key(hash,ver))
+
+    def put(self,hash,ver,result): self._results[self._get_key(hash,ver)]=result
+
+    def save(self):
+        temp_path=self._path+'.tmp'
+        with open(temp_path,'wt') as f:
+            json.dump({'version':CACHE_VERSION,'results':self._results},f)
+        os.replace(temp_path,self._path)
+
+##########################################################################
+##########################################################################
+
+vers_checked=['basic4','basic2']
+
+bbtt_decoders={ver:BBCBasicToText.Decoder(dialect=ver,codes=True,perfect=True)
+               for ver in vers_checked}
+
+bt_args=['--ascii','--input-tokenised','--output-binary']
+bt_ver_args={'basic4':[],'basic2':['--basic-2']}
+
+def check_file(hash,ver,output_folder,basictool):
+    '''check file with hash HASH, previously written to OUTPUT_FOLDER,
+for BASIC version VER. Returns (hash,ver,basictool_ok,match).'''
+    original_path=os.path.join(output_folder,'%s.original.dat'%hash)
+    with open(original_path,'rb') as f: data=f.read()
+
+    bbtt_text_path=os.path.join(output_folder,'%s.BBCBasicToText.%s.txt'%(hash,ver))
+    bbtt_data=bbtt_decoders[ver].get_text(data).encode('latin_1')
+    with open(bbtt_text_path,'wb') as f: f.write(bbtt_data)
+
+    bt_text_path=os.path.join(output_folder,'%s.basictool.%s.txt'%(hash,ver))
+    cmd_line=[basictool]+bt_args+bt_ver_args[ver]+[original_path,bt_text_path]
+    retcode=subprocess.call(cmd_line,shell=False)
+
+    # safest to treat the output as binary, on account of the
+    # possibility of embedded control codes.
+    with open(bt_text_path,'rb') as f: bt_data=f.read()
+
+    return hash,ver,retcode==0,bbtt_data==bt_data
+
+def _check_file_worker(args): return check_file(*args)
+
+##########################################################################
+##########################################################################
+
 def main2(options):
     folders=[]
     if options.beeblink_config is not None:
@@ -134,62 +217,89 @@ def main2(options):
                                                 total_num_basic_files))
 
     if options.output_folder is not None:
-        basictool_failures=[]
-        mismatches=[]
-
-        bbtt_args=['--codes','--perfect']
-        bt_args=['--ascii','--input-tokenised','--output-binary']
-        
         if not os.path.isdir(options.output_folder):
             os.makedirs(options.output_folder)
 
-        unique_files=[kv for kv in unique_files_by_hash.items()]
+        cache_path=options.cache
+        if cache_path is None:
+            cache_path=os.path.join(options.output_folder,'results.json')
+        cache=ResultsCache(cache_path,get_tool_version(options))
 
-        mismatches=''
-        num_mismatches=0
+        unique_files=[kv for kv in unique_files_by_hash.items()]
 
+        # only files with no cached result for some version need
+        # checking.
+        jobs=[]
         for i,kv in enumerate(unique_files):
+            vers=[ver for ver in vers_checked if cache.get(kv[0],ver) is None]
+            if len(vers)==0: continue
+            
             original_path=os.path.join(options.output_folder,
                                        '%s.original.dat'%kv[0])
             stripped_path=os.path.join(options.output_folder,
                                        '%s.stripped.dat'%kv[0])
 
-            if sys.stdout.isatty():
-                sys.stdout.write('\r%d/%d: %s (mismatches=%d)'%(i,len(unique_files),original_path,num_mismatches))
-                sys.stdout.flush()
-            
             with open(original_path,'wb') as f: f.write(kv[1].data)
 
             with open(stripped_path,'wb') as f:
                 if kv[1].basic_size==len(kv[1].data): f.write(kv[1].data)
                 else: f.write(kv[1].data[:kv[1].basic_size])
 
-            for basic2 in [False,True]:
-                ver='basic2' if basic2 else 'basic4'
-                bbtt_text_path=os.path.join(options.output_folder,'%s.BBCBasicToText.%s.txt'%(kv[0],ver))
-                BBCBasicToText.main(bbtt_args+[original_path,bbtt_text_path])
+            for ver in vers:
+                jobs.append((kv[0],ver,options.output_folder,options.basictool))
+
+        print('%d/%d checks cached; %d to do'%(len(unique_files)*len(vers_checked)-len(jobs),
+                                               len(unique_files)*len(vers_checked),
+                                               len(jobs)))
 
-                bt_text_path=os.path.join(options.output_folder,'%s.basictool.%s.txt'%(kv[0],ver))
-                cmd_line=[options.basictool]+bt_args+[original_path,bt_text_path]
-                retcode=subprocess.call(cmd_line,shell=False)
-                if retcode!=0: basictool_failures.append(i)
+        num_jobs=options.jobs
+        if num_jobs is None: num_jobs=os.cpu_count() or 1
+        num_jobs=max(1,min(num_jobs,len(jobs)))
 
-                # safest to treat the output as binary, on account of the
-                # possibility of embedded control codes.
-                with open(bt_text_path,'rb') as f: bt_data=f.read()
-                with open(bbtt_text_path,'rb') as f: bbtt_data=f.read()
+        num_done=0
+        def handle_result(hash,ver,basictool_ok,match):
+            nonlocal num_done
+            cache.put(hash,ver,[basictool_ok,match])
+            num_done+=1
+            if sys.stdout.isatty():
+                sys.stdout.write('\r%d/%d: %s (%s)'%(num_done,len(jobs),hash,ver))
+                sys.stdout.flush()
 
-                if bbtt_data!=bt_data:
+            # save occasionally, so an interrupted run isn't wasted.
+            if num_done%1000==0: cache.save()
+
+        try:
+            if num_jobs==1:
+                for job in jobs: handle_result(*check_file(*job))
+            else:
+                with multiprocessing.Pool(num_jobs) as pool:
+                    for result in pool.imap_unordered(_check_file_worker,
+                                                      jobs,
+                                                      chunksize=max(1,min(16,len(jobs)//(num_jobs*4)))):
+                        handle_result(*result)
+        finally: cache.save()
+        print()
+
+        basictool_failures=[]
+        mismatches=''
+        num_mismatches=0
+        for kv in unique_files:
+            for ver in vers_checked:
+                basictool_ok,match=cache.get(kv[0],ver)
+                if not basictool_ok: basictool_failures.append(kv[0])
+                
+                if not match:
+                    bbtt_text_path=os.path.join(options.output_folder,'%s.BBCBasicToText.%s.txt'%(kv[0],ver))
+                    bt_text_path=os.path.join(options.output_folder,'%s.basictool.%s.txt'%(kv[0],ver))
                     mismatches+='** %s (%s)\n'%(kv[0],ver)
                     mismatches+='  vbindiff %s %s\n'%(bbtt_text_path,bt_text_path)
                     mismatches+='  (%d BASIC bytes; original path: %s)\n'%(kv[1].basic_size,kv[1].path)
                     
                     num_mismatches+=1
-        print()
 
         if len(basictool_failures)>0:
             print('basictool failures:')
-            for i in basictool_failures: print('  %s'%unique_files[i][0])
+            for hash in basictool_failures: print('  %s'%hash)
 
         if len(mismatches)>0:
             print('mismatches:')
@@ -208,6 +318,10 @@ def main(argv):
 
     parser.add_argument('--basictool',metavar='PATH',default='basictool',help='''run basictool as %(metavar)s. Default: %(default)s''')
 
+    parser.add_argument('-j','--jobs',metavar='N',type=int,default=None,help='''run checks using %(metavar)s processes. Default: one per CPU''')
+
+    parser.add_argument('--cache',metavar='FILE',default=None,help='''cache check results in %(metavar)s. Default: results.json in the output folder''')
+
     parser.add_argument('folders',nargs='*',metavar='PATH',help='''look for BBC BASIC file(s) in %(metavar)s''')
 
     main2(parser.parse_args(argv))
@@ -0,0 +1,43 @@
+#!/usr/bin/python3
+import sys,os,os.path
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),'../../bin/'))
+import TextToBBCBasic
+
+##########################################################################
+##########################################################################
+
+# (dialect, line text, expected tokenised bytes). The pseudo-variables
+# (PTR, PAGE, TIME, LOMEM, HIMEM) have different tokens at the start
+# of a statement, which detokenise to the same text - so these have to
+# be checked at the byte level.
+cases=[
+    ('basic2','TIME=0','d1 3d 30'),
+    ('basic2','PRINT TIME','f1 20 91'),
+    ('basic2','IF TIME>100 THEN TIME=0','e7 20 91 3e 31 30 30 20 8c 20 d1 3d 30'),
+    ('basic2','A=TIME:PTR#F=0','41 3d 91 3a cf 23 46 3d 30'),
+    ('basic2','GOTO 10','e5 20 8d 54 4a 40'),
+    ('basic2','ENDX=1:END','45 4e 44 58 3d 31 3a e0'),
+    ('basicv','WHILE TIME<100','c8 95 20 91 3c 31 30 30'),
+    ('basicv','CASE TIME OF','c8 8e 20 91 20 ca'),
+    ('basicv','WHILE PTR#F<10','c8 95 20 8f 23 46 3c 31 30'),
+    ('basicv','WHEN 1:TIME=0','c9 20 31 3a d1 3d 30'),
+    ('basicv','SYS 6,TIME','c8 99 20 36 2c 91'),
+    ('basicv','IF X THEN 100 ELSE 20','e7 20 58 20 8c 20 8d 44 64 40 20 8b 20 8d 54 54 40'),
+]
+
+def test_tokenise_line():
+    tokenisers={}
+    for dialect,text,expected in cases:
+        if dialect not in tokenisers:
+            tokenisers[dialect]=TextToBBCBasic.Tokeniser(dialect)
+
+        got=tokenisers[dialect].tokenise_line(text).hex(' ')
+        assert got==expected,'%s: %s: got %s, expected %s'%(dialect,text,got,expected)
+
+##########################################################################
+##########################################################################
+
+if __name__=='__main__':
+    test_tokenise_line()
+    print('%d cases OK'%len(cases))